@@ -0,0 +1,34 @@
+"""
+Ahead-of-time compiles the CPU harmonic group detection
+(wavetracker/_hg_numba.py) into the extension module
+wavetracker/_wavetracker_hg, which wavetracker imports in place of the
+JIT-compiled functions. This skips the compilation on the first snippet of
+every run (the on-disk cache of the JIT functions only helps once it is
+populated and is invalidated by numba updates).
+
+AOT compiled code runs single-threaded, numba.pycc does not support
+parallel loops. Use it where the JIT warm-up matters more than the
+parallelization, e.g. many short recordings.
+
+Usage: python build_aot.py
+"""
+
+import os
+
+from numba.pycc import CC
+
+from wavetracker import _hg_numba
+
+cc = CC("_wavetracker_hg")
+cc.output_dir = os.path.join(os.path.dirname(__file__), "wavetracker")
+cc.verbose = True
+
+cc.export(
+    "harmonic_groups_batch",
+    "Tuple((f8[:], i4[:], i8[:]))"
+    "(f4[:, :], f8[:], f8, f8, f8, f8, f8, f8, f8, i8, i8, f8)",
+)(_hg_numba.harmonic_groups_batch.py_func)
+cc.export("noise_std", "f8(f4[:, :])")(_hg_numba.noise_std.py_func)
+
+if __name__ == "__main__":
+    cc.compile()
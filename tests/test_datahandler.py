@@ -0,0 +1,92 @@
+"""
+Checks that RawBlockReader assembles the channels of multi-file fishgrid and relacs recordings like the thunderlab
+DataLoader, and that raw_trace_files rejects files that do not match the recording.
+"""
+
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("thunderlab")
+
+from wavetracker.datahandler import (  # noqa: E402
+    RawBlockReader,
+    raw_trace_files,
+)
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(os, "preadv"), reason="os.preadv not available"
+)
+
+
+def _write_traces(folder, data, file_channels, name):
+    """
+    Writes the channels of data (samples x channels) to one float32 .raw file per entry of file_channels.
+    """
+    paths = []
+    offset = 0
+    for k, channels in enumerate(file_channels):
+        path = folder / name.format(k + 1)
+        data[:, offset : offset + channels].astype(np.float32).tofile(path)
+        paths.append(path)
+        offset += channels
+    return paths
+
+
+def _loader(data_format, paths, data, grid_channels=None):
+    """
+    Stand-in for the attributes of a thunderlab DataLoader read by raw_trace_files.
+    """
+    return SimpleNamespace(
+        format=data_format,
+        trace_filepaths=paths,
+        grid_channels=grid_channels,
+        channels=data.shape[1],
+        shape=data.shape,
+    )
+
+
+@pytest.mark.parametrize(
+    ("data_format", "file_channels", "name"),
+    [
+        ("FISHGRID", [4], "traces-grid{}.raw"),
+        ("FISHGRID", [4, 2, 3], "traces-grid{}.raw"),
+        ("RELACS", [1, 1, 1], "trace-{}.raw"),
+    ],
+)
+def test_raw_block_reader(tmp_path, data_format, file_channels, name):
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((1000, sum(file_channels))).astype(np.float32)
+    paths = _write_traces(tmp_path, data, file_channels, name)
+
+    files = raw_trace_files(_loader(data_format, paths, data, file_channels))
+    assert files is not None
+    with RawBlockReader(files, 20000.0, len(data), depth=2) as reader:
+        assert reader.shape == data.shape
+        np.testing.assert_array_equal(reader[100:300], data[100:300])
+        np.testing.assert_array_equal(reader[990:2000], data[990:])
+        assert len(reader[2000:3000]) == 0
+
+        blocks = [block.copy() for block in reader.blocks(300, 100)]
+        starts = range(0, len(data) - 100, 200)
+        assert len(blocks) == len(starts)
+        for i0, block in zip(starts, blocks, strict=True):
+            np.testing.assert_array_equal(block, data[i0 : i0 + 300])
+
+
+def test_raw_trace_files_mismatch(tmp_path):
+    rng = np.random.default_rng(1)
+    data = rng.standard_normal((500, 3)).astype(np.float32)
+
+    # a single file with fewer channels than the recording
+    paths = _write_traces(tmp_path, data, [2], "traces-grid{}.raw")
+    assert raw_trace_files(_loader("FISHGRID", paths, data, [3])) is None
+
+    # a relacs trace file is not the whole recording
+    paths = _write_traces(tmp_path, data, [1, 1, 1], "trace-{}.raw")
+    assert raw_trace_files(_loader("RELACS", paths[:1], data)) is None
+
+    # other formats are read by the DataLoader
+    assert raw_trace_files(_loader("WAV", paths, data)) is None
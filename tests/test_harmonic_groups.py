@@ -0,0 +1,169 @@
+"""
+Checks the harmonic group detection of the CPU pathway (_hg_numba.py) against the fundamentals of a synthetic
+spectrogram, and the flat fundamental extraction against get_fundamentals. The comparison with the CUDA pipeline of
+gpu_harmonic_group.py only runs on a GPU.
+"""
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("numba")
+pytest.importorskip("matplotlib")
+pytest.importorskip("IPython")
+
+from numba import cuda  # noqa: E402
+
+from wavetracker._hg_numba import harmonic_groups_batch  # noqa: E402
+from wavetracker.gpu_harmonic_group import (  # noqa: E402
+    get_fundamentals,
+    get_fundamentals_flat,
+    harmonic_group_pipeline,
+)
+
+HARMONIC_GROUPS = {
+    "low_threshold": 2.0,
+    "high_threshold": 10.0,
+    "max_freq_tol": 1.0,
+    "mains_freq": 50.0,
+    "mains_freq_tol": 1.0,
+    "min_freq": 400.0,
+    "max_freq": 1200.0,
+    "max_divisor": 3,
+    "min_group_size": 3,
+    "min_good_peak_power": -100.0,
+}
+
+
+DF = 2.0
+N_FREQS = 2049
+# fundamental frequency bins and powers of the fish in each time bin, in order
+# of decreasing power; the harmonics of different fish are at least 3 bins
+# apart
+FISH = [
+    [(210, 1e-3), (253, 3e-4), (296, 1e-4)],
+    [(253, 1e-3), (210, 3e-4)],
+    [(296, 1e-3), (210, 3e-4), (253, 1e-4)],
+    [],
+]
+
+
+def _fish_spec(rng):
+    """
+    Power spectrogram (frequencies x time bins) of a noise floor, the harmonics of the fish in FISH and mains hum.
+    """
+    spec_freq = np.arange(N_FREQS) * DF
+    spec = 1e-8 * (1 + rng.random((N_FREQS, len(FISH))))
+    for t, fish in enumerate(FISH):
+        for f0, power in fish:
+            h = np.arange(1, N_FREQS // f0 + 1)
+            spec[h * f0, t] += power / h
+        # mains hum at 1000 Hz is never a fundamental
+        spec[500, t] += 1e-2
+    return spec.astype(np.float32), spec_freq
+
+
+def _fish_fundamentals(spec_freq):
+    """
+    Fundamentals, time and frequency indices of FISH as returned by harmonic_groups_batch.
+    """
+    f_idx = np.array([f0 for fish in FISH for f0, _ in fish], dtype=int)
+    t_idx = np.array([t for t, fish in enumerate(FISH) for _ in fish])
+    return spec_freq[f_idx], t_idx, f_idx
+
+
+def _harmonic_groups_batch(spec, spec_freq):
+    """
+    harmonic_groups_batch with the parameters of HARMONIC_GROUPS.
+    """
+    hg = HARMONIC_GROUPS
+    return harmonic_groups_batch(
+        spec,
+        spec_freq,
+        hg["low_threshold"],
+        hg["high_threshold"],
+        hg["min_freq"],
+        hg["max_freq"],
+        hg["mains_freq"],
+        hg["mains_freq_tol"],
+        hg["min_good_peak_power"],
+        hg["max_divisor"],
+        hg["min_group_size"],
+        hg["max_freq_tol"],
+    )
+
+
+def _random_spec(rng, n_freqs=2049, n_times=6, df=2.0):
+    """
+    Power spectrogram (frequencies x time bins) of a random noise floor with the harmonics of a few fish.
+    """
+    spec_freq = np.arange(n_freqs) * df
+    spec = (1e-8 * (1 + rng.random((n_freqs, n_times)))).astype(np.float32)
+    for t in range(n_times):
+        for f0 in rng.integers(201, 600, size=3):
+            for h in range(1, n_freqs // f0):
+                spec[h * f0, t] += 1e-3 * rng.uniform(0.5, 1) / h
+    return spec, spec_freq
+
+
+def _flatten(f_list, spec_freq):
+    """
+    Flat fundamentals, time and frequency indices of the nested output of get_fundamentals.
+    """
+    fund = np.array([f for fs in f_list for f in fs])
+    t_idx = np.array([t for t, fs in enumerate(f_list) for _ in fs])
+    f_idx = np.searchsorted(spec_freq, fund)
+    return fund, t_idx, f_idx
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_get_fundamentals_flat(seed):
+    rng = np.random.default_rng(seed)
+    spec_freq = np.arange(500) * 0.5
+    assigned_hg = rng.integers(0, 8, size=(20, 500))
+    assigned_hg[rng.random(assigned_hg.shape) < 0.8] = 0
+    assigned_hg[3] = 0
+
+    fund, t_idx, f_idx = get_fundamentals_flat(assigned_hg, spec_freq)
+    ref = _flatten(get_fundamentals(assigned_hg, spec_freq), spec_freq)
+
+    np.testing.assert_array_equal(fund, ref[0])
+    np.testing.assert_array_equal(t_idx, ref[1])
+    np.testing.assert_array_equal(f_idx, ref[2])
+
+
+def test_get_fundamentals_flat_empty():
+    spec_freq = np.arange(10) * 0.5
+    fund, t_idx, f_idx = get_fundamentals_flat(
+        np.zeros((4, 10), dtype=int), spec_freq
+    )
+    assert len(fund) == len(t_idx) == len(f_idx) == 0
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_harmonic_groups_batch(seed):
+    spec, spec_freq = _fish_spec(np.random.default_rng(seed))
+    fund, t_idx, f_idx = _harmonic_groups_batch(spec, spec_freq)
+    ref = _fish_fundamentals(spec_freq)
+
+    np.testing.assert_array_equal(fund, ref[0])
+    np.testing.assert_array_equal(t_idx, ref[1])
+    np.testing.assert_array_equal(f_idx, ref[2])
+
+
+@pytest.mark.skipif(not cuda.is_available(), reason="CUDA not available")
+@pytest.mark.parametrize("seed", [0, 1])
+def test_harmonic_groups_batch_gpu(seed):
+    rng = np.random.default_rng(seed)
+    spec, spec_freq = _random_spec(rng)
+    fund, t_idx, f_idx = _harmonic_groups_batch(spec, spec_freq)
+
+    cfg = SimpleNamespace(harmonic_groups=dict(HARMONIC_GROUPS))
+    assigned_hg, _, _ = harmonic_group_pipeline(spec, spec_freq, cfg)
+    ref = _flatten(get_fundamentals(assigned_hg, spec_freq), spec_freq)
+
+    assert len(fund) > 0
+    np.testing.assert_array_equal(fund, ref[0])
+    np.testing.assert_array_equal(t_idx, ref[1])
+    np.testing.assert_array_equal(f_idx, ref[2])
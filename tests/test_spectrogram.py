@@ -0,0 +1,74 @@
+"""
+Runs the spectrogram entry point on a short recording and checks the CPU snippet loop against a spectrogram of the
+whole recording.
+"""
+
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("scipy")
+pytest.importorskip("thunderlab")
+pytest.importorskip("matplotlib")
+wavfile = pytest.importorskip("scipy.io.wavfile")
+
+from wavetracker import spectrogram  # noqa: E402
+
+SAMPLERATE = 8000
+CONFIG = """\
+basic:
+  project: wavetracker
+spectrogram:
+  snippet_size: 2
+  snippet_overlap_frac: 0.1
+  nfft: 8192
+  overlap_frac: 0.9
+  raw_readahead: 0
+"""
+
+
+@pytest.fixture
+def recording(tmp_path):
+    """
+    An 8 s recording of three channels and a config file with short snippets.
+    """
+    rng = np.random.default_rng(0)
+    data = rng.integers(-(2**14), 2**14, (8 * SAMPLERATE, 3), dtype=np.int16)
+    path = tmp_path / "recording.wav"
+    wavfile.write(path, SAMPLERATE, data)
+    (tmp_path / "cfg.yaml").write_text(CONFIG)
+    # 16 bit samples are loaded scaled to [-1, 1)
+    return path, data.astype(np.float32) / 2**15
+
+
+def test_main_cpu(recording, monkeypatch):
+    path, data = recording
+    calls = []
+    snippet_spectrogram = spectrogram.Spectrogram.snippet_spectrogram
+
+    def record(self, data_snippet, snipptet_t0):
+        calls.append((data_snippet.copy(), snipptet_t0, self.terminate))
+        snippet_spectrogram(self, data_snippet, snipptet_t0)
+
+    monkeypatch.setattr(
+        spectrogram.Spectrogram, "snippet_spectrogram", record
+    )
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["spectrogram", str(path), "-c", str(path.parent), "--cpu"],
+    )
+    spectrogram.main()
+
+    assert len(calls) > 1
+    snippet_size = len(calls[0][0][0])
+    hop = snippet_size - int(0.1 * 2 * SAMPLERATE)
+    for k, (snippet, _, terminate) in enumerate(calls):
+        assert snippet.shape[0] == data.shape[1]
+        np.testing.assert_array_equal(
+            snippet, data[k * hop : k * hop + snippet_size].T
+        )
+        assert terminate == (k == len(calls) - 1)
+    assert (len(calls) - 1) * hop + snippet_size >= len(data)
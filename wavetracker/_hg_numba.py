@@ -0,0 +1,425 @@
+"""
+CPU implementation of the harmonic group detection of gpu_harmonic_group.py compiled with numba. All time bins of a
+snippet spectrogram are processed in one call, distributed over the CPU cores.
+"""
+
+import math
+
+import numpy as np
+from numba import njit, prange
+
+HIST_BINS = 100
+DETREND_WIDTH = 128
+# all fast-math flags except nnan/ninf: decibel spectra contain -inf
+FASTMATH = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
+
+@njit(fastmath=FASTMATH, cache=True, boundscheck=False)
+def _decibel(power, db_power):
+    """
+    Transforms power to decibel (reference power 1). Power values smaller than 1e-20 are set to -inf.
+    """
+    for i in range(len(power)):
+        if power[i] <= 1e-20:
+            db_power[i] = -np.inf
+        else:
+            db_power[i] = 10.0 * math.log10(power[i])
+
+
+@njit(cache=True, boundscheck=False)
+def _std_estimate(log_spec):
+    """
+    Estimates the standard deviation of the noise floor of a decibel spectrum from the width of the histogram of its
+    detrended upper half (see threshold_estimate in gpu_harmonic_group.py).
+    """
+    n = len(log_spec)
+    i0, i1 = n // 2, n * 3 // 4
+    abs_mean_val = 0.0
+    for i in range(i0, i1):
+        abs_mean_val += log_spec[i]
+    abs_mean_val /= i1 - i0
+
+    detrend = np.zeros(i1 - i0)
+    for k in range((i1 - i0) // DETREND_WIDTH):
+        j0 = i0 + k * DETREND_WIDTH
+        mean_val = 0.0
+        for j in range(DETREND_WIDTH):
+            mean_val += log_spec[j0 + j]
+        mean_val /= DETREND_WIDTH
+        for j in range(DETREND_WIDTH):
+            detrend[k * DETREND_WIDTH + j] = (
+                log_spec[j0 + j] - mean_val + abs_mean_val
+            )
+
+    maxd = -1e6
+    mind = 1e6
+    for i in range(len(detrend)):
+        maxd = max(detrend[i], maxd)
+        mind = min(detrend[i], mind)
+
+    r = maxd - mind
+    bins = np.empty(HIST_BINS + 1)
+    hist = np.zeros(HIST_BINS)
+    for i in range(HIST_BINS):
+        bins[i] = mind + r / HIST_BINS * i
+    bins[HIST_BINS] = maxd
+    for j in range(len(detrend)):
+        for i in range(HIST_BINS):
+            if detrend[j] >= bins[i] and detrend[j] < bins[i + 1]:
+                hist[i] += 1
+                break
+    hist_th = np.max(hist) / math.sqrt(math.e)
+
+    lower = 0.0
+    upper = 0.0
+    for j in range(HIST_BINS):
+        if hist[j] > hist_th:
+            upper = bins[j + 1]
+            if lower == 0:
+                lower = bins[j]
+    return 0.5 * (upper - lower)
+
+
+@njit(fastmath=FASTMATH, cache=True, boundscheck=False)
+def _detect_peaks(
+    data,
+    peaks,
+    spec_freq,
+    low_threshold,
+    high_threshold,
+    min_freq,
+    max_freq,
+    mains_freq,
+    mains_freq_tol,
+    min_good_peak_power,
+):
+    """
+    Peak detection of detect_peaks_fixed in gpu_harmonic_group.py. Peaks are marked with 1, peaks passing the
+    threshold, frequency and power criteria with 2.
+    """
+    direction = 0
+    min_inx = 0
+    max_inx = 0
+    last_min_idx = 0
+    last_max_idx = 0
+    peak_count = 0
+    trough_count = 0
+    min_value = data[0]
+    max_value = min_value
+    p, t = 0, 0
+
+    for i in range(len(data)):
+        if direction > 0:
+            if data[i] > max_value:
+                max_inx = i
+                max_value = data[i]
+            if data[i] <= max_value - low_threshold:
+                peaks[max_inx] = 1
+                p = 1
+                last_max_idx = max_inx
+                peak_count += 1
+                direction = -1
+                min_inx = i
+                min_value = data[i]
+
+        if direction < 0:
+            if data[i] < min_value:
+                min_inx = i
+                min_value = data[i]
+            if data[i] >= min_value + low_threshold:
+                t = 1
+                last_min_idx = min_inx
+                trough_count += 1
+                direction = 1
+                max_inx = i
+                max_value = data[i]
+
+        if direction == 0:
+            if data[i] <= max_value - low_threshold:
+                direction = -1
+            if data[i] >= min_value + low_threshold:
+                direction = 1
+            if data[i] > max_value:
+                max_inx = i
+                max_value = data[i]
+            if data[i] < min_value:
+                min_inx = i
+                min_value = data[i]
+
+        if p != 0 and t != 0:
+            p, t = 0, 0
+            if not data[last_max_idx] - data[last_min_idx] > high_threshold:
+                continue
+            f = spec_freq[last_max_idx]
+            if f < min_freq or f > max_freq:
+                continue
+            if f % mains_freq < mains_freq_tol:
+                continue
+            if abs(f % mains_freq - mains_freq) < mains_freq_tol:
+                continue
+            if data[last_max_idx] < min_good_peak_power:
+                continue
+            peaks[last_max_idx] = 2
+
+    if peak_count > trough_count:
+        peaks[last_max_idx] = 0
+
+
+@njit(fastmath=FASTMATH, cache=True, boundscheck=False)
+def _get_group(
+    freq,
+    log_spec,
+    spec_freq,
+    peaks,
+    out,
+    min_group_size,
+    max_freq_tol,
+    mains_freq,
+    mains_freq_tol,
+):
+    """
+    Collects the peaks of the harmonics of freq in out (see get_group in gpu_harmonic_group.py) and returns the mean
+    power of the first min_group_size harmonics.
+    """
+    fzero = freq
+    fzero_h = 1
+    for h in range(1, len(out)):
+        ioi = 0
+        fe = 1e6
+        for i in range(len(peaks)):
+            if peaks[i] != 0:
+                new_fe = abs(spec_freq[i] / h - fzero / fzero_h)
+                if new_fe < fe and new_fe < max_freq_tol:
+                    ioi = i
+                    fe = new_fe
+                if new_fe > fe:
+                    if ioi != 0:
+                        fzero = spec_freq[ioi]
+                        fzero_h = h
+                        out[h - 1] = ioi
+
+    peak_sum = 0.0
+    n = 0
+    nn = 0
+    for i in range(min_group_size):
+        if out[i] != 0:
+            nn += 1
+            f = spec_freq[out[i]]
+            if (
+                f % mains_freq < mains_freq_tol
+                or abs(f % mains_freq - mains_freq) < mains_freq_tol
+            ):
+                continue
+            n += 1
+            peak_sum += log_spec[out[i]]
+
+    if nn < min_group_size - 1 or n == 0:
+        return -1e6
+    return peak_sum / n
+
+
+@njit(fastmath=FASTMATH, cache=True, boundscheck=False)
+def _assign_groups(
+    log_spec,
+    spec_freq,
+    peaks,
+    f0_idx,
+    min_freq,
+    max_freq,
+    max_divisor,
+    min_group_size,
+    max_group_size,
+    max_freq_tol,
+    mains_freq,
+    mains_freq_tol,
+    min_good_peak_power,
+):
+    """
+    Harmonic group search and assignment of a single time bin (see harmonic_group_pipeline in
+    gpu_harmonic_group.py). Writes the frequency index of the fundamental of every assigned group to f0_idx and
+    returns the number of groups.
+    """
+    good = np.flatnonzero(peaks == 2)
+
+    # candidate fundamentals: good peaks and their subharmonics
+    fs = np.empty(len(good))
+    n_fs = 0
+    for i in good:
+        if spec_freq[i] > min_freq and spec_freq[i] < max_freq:
+            fs[n_fs] = spec_freq[i]
+            n_fs += 1
+    n_check = n_fs * max_divisor
+
+    out = np.zeros((n_check, max_group_size), dtype=np.int64)
+    value = np.empty(n_check)
+    for d in range(max_divisor):
+        for k in range(n_fs):
+            j = d * n_fs + k
+            value[j] = _get_group(
+                fs[k] / (d + 1),
+                log_spec,
+                spec_freq,
+                peaks,
+                out[j],
+                min_group_size,
+                max_freq_tol,
+                mains_freq,
+                mains_freq_tol,
+            )
+
+    # strongest groups first, only groups with all of the first
+    # min_group_size harmonics present
+    order = np.argsort(value)[::-1]
+    complete = np.ones(n_check, dtype=np.bool_)
+    for j in range(n_check):
+        for h in range(min_group_size):
+            if out[j, h] == 0:
+                complete[j] = False
+                break
+    order = order[complete[order]]
+
+    assigned = np.zeros(len(peaks), dtype=np.int64)
+    n_groups = 0
+    for search_idx in good[np.argsort(log_spec[good])[::-1]]:
+        for j in order:
+            member = False
+            for h in range(min_group_size):
+                if out[j, h] == search_idx:
+                    member = True
+                    break
+            if not member:
+                continue
+            if log_spec[out[j, 0]] < min_good_peak_power:
+                continue
+            used = 0
+            for h in range(max_group_size):
+                if out[j, h] != 0:
+                    used += assigned[out[j, h]]
+            if used != 0:
+                continue
+            lowest = out[j, 0]
+            for h in range(max_group_size):
+                if out[j, h] != 0:
+                    assigned[out[j, h]] += 1
+                    lowest = min(lowest, out[j, h])
+            f0_idx[n_groups] = lowest
+            n_groups += 1
+            break
+    return n_groups
+
+
+@njit(parallel=True, fastmath=FASTMATH, cache=True, boundscheck=False)
+def harmonic_groups_batch(
+    spec,
+    spec_freq,
+    low_threshold,
+    high_threshold,
+    min_freq,
+    max_freq,
+    mains_freq,
+    mains_freq_tol,
+    min_good_peak_power,
+    max_divisor,
+    min_group_size,
+    max_freq_tol,
+):
+    """
+    Detects harmonic groups in all time bins of a spectrogram. Same algorithm as harmonic_group_pipeline in
+    gpu_harmonic_group.py, with the time bins processed in parallel.
+
+    Parameters
+    ----------
+        spec : 2d-array
+            Contiguous float32 power spectrogram (frequencies x time bins).
+        spec_freq : 1d-array
+            Frequencies of the spectrogram.
+        low_threshold, high_threshold : float
+            Thresholds (dB) of the peak detection (see noise_std).
+        min_freq, max_freq, mains_freq, mains_freq_tol, min_good_peak_power, max_divisor, min_group_size,
+        max_freq_tol :
+            Harmonic group parameters of the config file.
+
+    Returns
+    -------
+        fund : 1d-array
+            Fundamental frequencies of the detected harmonic groups.
+        t_idx : 1d-array
+            Time bin of each fundamental.
+        f_idx : 1d-array
+            Frequency bin of each fundamental.
+    """
+    n_freqs, n_times = spec.shape
+    max_group_size = int(max_freq * min_group_size // min_freq)
+
+    log_spec = np.empty((n_times, n_freqs), dtype=np.float32)
+    for t in prange(n_times):
+        _decibel(spec[:, t], log_spec[t])
+
+    f0_idx = np.zeros((n_times, n_freqs // 2 + 1), dtype=np.int64)
+    counts = np.zeros(n_times, dtype=np.int64)
+    for t in prange(n_times):
+        peaks = np.zeros(n_freqs, dtype=np.int8)
+        _detect_peaks(
+            log_spec[t],
+            peaks,
+            spec_freq,
+            low_threshold,
+            high_threshold,
+            min_freq,
+            max_freq,
+            mains_freq,
+            mains_freq_tol,
+            min_good_peak_power,
+        )
+        counts[t] = _assign_groups(
+            log_spec[t],
+            spec_freq,
+            peaks,
+            f0_idx[t],
+            min_freq,
+            max_freq,
+            max_divisor,
+            min_group_size,
+            max_group_size,
+            max_freq_tol,
+            mains_freq,
+            mains_freq_tol,
+            min_good_peak_power,
+        )
+
+    # fundamentals of each time bin in order of assignment, as get_fundamentals
+    offsets = np.zeros(n_times + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    t_idx = np.empty(offsets[-1], dtype=np.int32)
+    f_idx = np.empty(offsets[-1], dtype=np.int64)
+    for t in prange(n_times):
+        o0, o1 = offsets[t], offsets[t + 1]
+        f_idx[o0:o1] = f0_idx[t, : counts[t]]
+        t_idx[o0:o1] = t
+    return spec_freq[f_idx], t_idx, f_idx
+
+
+@njit(parallel=True, fastmath=FASTMATH, cache=True, boundscheck=False)
+def noise_std(spec):
+    """
+    Estimates the standard deviation of the noise floor (dB) of a spectrogram, averaged over its time bins. Scaled by
+    low_thresh_factor and high_thresh_factor it yields the thresholds of the peak detection, as estimated in
+    harmonic_group_pipeline of gpu_harmonic_group.py.
+
+    Parameters
+    ----------
+        spec : 2d-array
+            Contiguous float32 power spectrogram (frequencies x time bins).
+
+    Returns
+    -------
+        std : float
+            Mean standard deviation of the noise floor.
+    """
+    n_freqs, n_times = spec.shape
+    std = np.empty(n_times)
+    for t in prange(n_times):
+        log_spec = np.empty(n_freqs, dtype=np.float32)
+        _decibel(spec[:, t], log_spec)
+        std[t] = _std_estimate(log_spec)
+    return np.mean(std)
@@ -1,7 +1,150 @@
+import copy
+import functools
+import io
+import itertools
 import os
+import re
 import sys
 
-import ruamel.yaml
+import numpy as np
+import yaml
+
+try:
+    from yaml import CSafeLoader
+except ImportError as e:
+    msg = (
+        "PyYAML was built without LibYAML bindings (yaml.CSafeLoader is "
+        "missing). Reinstall PyYAML against libyaml, e.g. "
+        "'pip install --force-reinstall --no-binary pyyaml pyyaml'."
+    )
+    raise ImportError(msg) from e
+
+
+def _to_builtin(value):
+    """
+    Converts numpy scalars and arrays in a (nested) config value to python scalars and lists, which yaml can
+    represent, e.g. the np.float64 thresholds harmonic_group_pipeline stores in the config.
+    """
+    if isinstance(value, dict):
+        for key, item in value.items():
+            value[key] = _to_builtin(item)
+        return value
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_builtin(item) for item in value)
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    return value
+
+
+def _write_atomic(path: str, text: str) -> None:
+    """
+    Writes text to a temporary file that then replaces path, so a failing or interrupted save never leaves a
+    truncated config file.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+@functools.lru_cache(maxsize=32)
+def _load_cfg(path: str, mtime_ns: int) -> dict:
+    """
+    Parse a config file. Results are cached by path and modification time, so repeated loads of an unchanged file
+    skip file I/O and parsing while edits to the file still invalidate the cache.
+
+    Parameters
+    ----------
+        path : str
+            Real path of the .yaml file.
+        mtime_ns : int
+            Modification time of the file in ns; only used as part of the cache key.
+
+    Returns
+    -------
+        cfg : dict
+            Parsed configuration. Shared between cache hits, copy before mutating.
+    """
+    with open(path) as f:
+        return yaml.load(f, Loader=CSafeLoader)
+
+
+_PROJECT_RE = re.compile(r"^\s*project:\s*wavetracker", re.MULTILINE)
+
+
+def _is_wavetracker_cfg(path: str, nlines: int = 20) -> bool:
+    """
+    Check whether a .yaml file is a wavetracker config by matching "project: wavetracker" in its first lines, without
+    parsing the whole file.
+
+    Parameters
+    ----------
+        path : str
+            Path of the .yaml file.
+        nlines : int
+            Number of lines at the head of the file that are searched.
+
+    Returns
+    -------
+        is_cfg : bool
+            True if the file header declares the wavetracker project.
+    """
+    try:
+        with open(path) as f:
+            head = "".join(itertools.islice(f, nlines))
+    except (OSError, UnicodeDecodeError):
+        return False
+    return _PROJECT_RE.search(head) is not None
+
+
+def _scan_for_yaml(folder: str, max_depth: int = 1) -> str | None:
+    """
+    Return the first wavetracker config (.yaml) in folder. Subfolders are only searched when the top level holds no
+    config, and not deeper than max_depth. Uses os.scandir so the file type comes from the cached directory entry
+    instead of an extra stat call per file.
+
+    Parameters
+    ----------
+        folder : str
+            Folder to search.
+        max_depth : int
+            How many levels of subfolders are searched below folder.
+
+    Returns
+    -------
+        file : str or None
+            Path of the first config file found, None if there is none.
+    """
+    subfolders = []
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.is_file(follow_symlinks=False):
+                    if entry.name.endswith(".yaml") and _is_wavetracker_cfg(
+                        entry.path
+                    ):
+                        return entry.path
+                elif max_depth > 0 and entry.is_dir(follow_symlinks=False):
+                    subfolders.append(entry.path)
+    except OSError:
+        return None
+
+    for subfolder in subfolders:
+        file = _scan_for_yaml(subfolder, max_depth - 1)
+        if file:
+            return file
+    return None
+
+
+KNOWN_SECTIONS = (
+    "basic",
+    "data_processing",
+    "raw",
+    "spectrogram",
+    "harmonic_groups",
+    "tracking",
+)
+"""Top-level sections a config file may contain."""
 
 
 class Configuration:
@@ -10,6 +153,8 @@ class Configuration:
     The Object attributes refelct the differen analysis stages, e.g. "spectrogram", "harmonix_groups", and "tracking".
     """
 
+    __slots__ = ("file", "verbose", "yaml", "cfg", "dicts", *KNOWN_SECTIONS)
+
     def __init__(
         self,
         folder: str = None,
@@ -49,28 +194,33 @@ class Configuration:
             # if logger:
             logger.info(f"Config file from: {os.path.realpath(self.file)}.")
 
-        self.yaml = ruamel.yaml.YAML()
-        with open(self.file) as f:
-            self.cfg = self.yaml.load(f)
-            self.dicts = list(self.cfg.keys())
-            for dict in self.cfg:
-                setattr(self, dict, self.cfg[dict])
-            f.close()
+        self.yaml = None
+        path = os.path.realpath(self.file)
+        self.cfg = copy.deepcopy(_load_cfg(path, os.stat(path).st_mtime_ns))
+        self.dicts = list(self.cfg.keys())
+        unknown = [d for d in self.dicts if d not in KNOWN_SECTIONS]
+        if unknown:
+            msg = (
+                f"Unknown section(s) {unknown} in config file {self.file}. "
+                f"Valid sections are {list(KNOWN_SECTIONS)}."
+            )
+            raise ValueError(msg)
+        for dict in self.cfg:
+            setattr(self, dict, self.cfg[dict])
+
+    @classmethod
+    def clear_cache(cls) -> None:
+        """
+        Drop all parsed config files memoized by previous Configuration instances.
+        """
+        _load_cfg.cache_clear()
 
     def __repr__(self) -> str:
         rep_list = []
-        for dict in self.dicts:
-            rep_list.append(f"{dict}:")
-            rep_list.extend(
-                list(
-                    f"  {k: <16}:  {v}"
-                    for k, v in zip(
-                        getattr(self, dict).keys(),
-                        getattr(self, dict).values(),
-                        strict=False,
-                    )
-                )
-            )
+        for d in self.dicts:
+            section = getattr(self, d)
+            rep_list.append(f"{d}:")
+            rep_list.extend(f"  {k: <16}:  {v}" for k, v in section.items())
         return "\n".join(rep_list)
 
     def find_config(self, folder) -> None:
@@ -92,20 +242,12 @@ class Configuration:
             os.path.dirname(os.path.abspath(__file__)),
         ]
 
-        found = False
         for search_folder in search_folders:
-            for dirpath, dirnames, filenames in os.walk(
-                search_folder, topdown=True
-            ):
-                for filename in [f for f in filenames if f.endswith(".yaml")]:
-                    self.file = os.path.join(dirpath, filename)
-                    found = True
-                    break
-                if found:
-                    break
-            if found:
+            file = _scan_for_yaml(search_folder)
+            if file:
+                self.file = file
                 break
-        if not found:
+        else:
             self.file = create_standard_cfg_file()
 
     @property
@@ -117,13 +259,60 @@ class Configuration:
 
     def save(self) -> None:
         """
-        Translate object attributes to a dictonary which will be saved in its original loading path.
+        Translate object attributes to a dictonary which will be saved in its original loading path. If the config
+        file contains comments, it is re-read in ruamel's round-trip mode so that they are preserved, otherwise it is
+        written with yaml.safe_dump.
         """
-        for dict in self.cfg:
-            self.cfg[dict] = getattr(self, dict)
-        with open(self.file, "w") as f:
-            self.yaml.dump(self.cfg, f)
-            f.close()
+        self.cfg.update({d: getattr(self, d) for d in self.dicts})
+        _to_builtin(self.cfg)
+
+        # the config is dumped completely before the file is replaced, so a
+        # value yaml cannot represent leaves the file untouched
+        with open(self.file) as f:
+            text = f.read()
+        if "#" not in text:
+            _write_atomic(
+                self.file,
+                yaml.safe_dump(
+                    self.cfg, sort_keys=False, default_flow_style=False
+                ),
+            )
+            return
+
+        import ruamel.yaml
+
+        if self.yaml is None:
+            self.yaml = ruamel.yaml.YAML()
+        rt_cfg = self.yaml.load(text)
+        if rt_cfg is None:
+            rt_cfg = {}
+        for d, section in self.cfg.items():
+            if d in rt_cfg and hasattr(rt_cfg[d], "update"):
+                rt_cfg[d].update(section)
+            else:
+                rt_cfg[d] = section
+
+        stream = io.StringIO()
+        self.yaml.dump(rt_cfg, stream)
+        _write_atomic(self.file, stream.getvalue())
+
+
+_DEFAULTS = {
+    "basic": {
+        "project": "wavetracker",
+        "version": 0.1,
+    },
+    "data_processing": {
+        "snippet_size": 2**21,
+        "channels": -1,
+    },
+    "spectrogram": {
+        "snippet": 2**21,
+        "nfft": 2**15,
+        "overlap_frac": 0.9,
+    },
+}
+"""Settings written by create_standard_cfg_file."""
 
 
 def create_standard_cfg_file(folder="."):
@@ -135,28 +324,9 @@ def create_standard_cfg_file(folder="."):
         folder : str
             Folder where the generated config-file shall be saved.
     """
-    yaml_str = """\
-    # Basic configureation
-    basic:
-      project: wavetracker
-      version: 0.1
-
-    # Data processing configuration
-    data_processing:
-      snippet_size: 2**21
-      channels: -1
-
-    # add another comment
-    spectrogram:
-      snippet: 2**21
-      nfft: 2**15
-      overlap_frac: 0.9
-    """
-    yaml = ruamel.yaml.YAML()  # defaults to round-trip if no parameters given
-    code = yaml.load(yaml_str)
-
     file = os.path.join(folder, "cfg.yaml")
-    yaml.dump(code, file)
+    with open(file, "w") as f:
+        yaml.safe_dump(_DEFAULTS, f, sort_keys=False, default_flow_style=False)
     return file
 
 
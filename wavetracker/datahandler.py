@@ -1,22 +1,28 @@
 import argparse
+import functools
+import itertools
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-import matplotlib.pyplot as plt
 import numpy as np
-import torch
-from PyQt5.QtCore import *
-from PyQt5.QtGui import *
 
 # from .spectrogram import *
-from PyQt5.QtWidgets import *
 from thunderlab.dataloader import DataLoader
 
 from wavetracker.device_check import get_device
 
 from .config import Configuration
 
-device = get_device()
-available_GPU = False if device.type == "cpu" else True
+
+@functools.lru_cache(maxsize=1)
+def _gpu_available() -> bool:
+    """
+    Check once, on first use, whether a GPU is available. Deferring this to call time keeps torch and CUDA
+    initialization out of the module import.
+    """
+    return get_device().type != "cpu"
+
 
 # os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 # try:
@@ -65,39 +71,276 @@ available_GPU = False if device.type == "cpu" else True
 #                 break
 
 
-class MultiChannelAudioDataset(torch.utils.data.IterableDataset):
-    """Iterator for loading data from a multi-channel audio file."""
+class RawBlockReader:
+    """Read-ahead block reader for float32 fishgrid and relacs `.raw` files.
+
+    A recording is stored in one or more `.raw` files, each holding
+    interleaved float32 samples of some of its channels: one
+    `traces-gridN.raw` file per grid for fishgrid, one `trace-K.raw` file per
+    channel for relacs. Each block is fetched with one positional read
+    (`os.preadv`) per file straight into one of a ring of preallocated
+    buffers, while a thread pool keeps up to `depth` block reads in flight.
+    Reading the next blocks thus overlaps with the analysis of the current
+    one. The interface mirrors the parts of
+    `thunderlab.dataloader.DataLoader` used by wavetracker.
+
+    Blocks yielded by `blocks()` are only valid until the generator is
+    resumed; copy them if they are needed longer.
+    """
 
     def __init__(
-        self, data_loader: DataLoader, block_size: int, noverlap: int = 0
+        self, files: list, rate: float, frames: int, depth: int = 2
     ) -> None:
-        """Initialize the iterator for loading data from a multi-channel audio.
+        """Initialize the reader.
+
+        Parameters
+        ----------
+        files : list of tuple
+            Path and channel count of each `.raw` file of the recording, in
+            the order of the channels.
+        rate : float
+            Samplerate of the data.
+        frames : int
+            Number of samples of the recording.
+        depth : int, optional
+            Number of block reads kept in flight, by default 2.
+        """
+        self.filenames = [str(path) for path, _ in files]
+        self.file_channels = [channels for _, channels in files]
+        self.rate = rate
+        self.channels = sum(self.file_channels)
+        self.depth = max(1, depth)
+        self.shape = (frames, self.channels)
+        self.fds = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, ex_type, ex_value, tb):
+        self.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["fds"] = None
+        return state
+
+    @staticmethod
+    def _open(filename: str) -> int:
+        try:
+            return os.open(filename, os.O_RDONLY | getattr(os, "O_NOATIME", 0))
+        except PermissionError:
+            # O_NOATIME is only permitted for the owner of the file
+            return os.open(filename, os.O_RDONLY)
+
+    def open(self):
+        """Open the file descriptors, skipping access time updates if allowed."""
+        if self.fds is None:
+            self.fds = [self._open(filename) for filename in self.filenames]
+
+    def close(self):
+        """Close the file descriptors."""
+        if self.fds is not None:
+            for fd in self.fds:
+                os.close(fd)
+            self.fds = None
+
+    def _read_file(self, fd: int, start: int, out: np.ndarray) -> int:
+        """Read samples of one file from frame start on into out, return the number of frames read."""
+        view = memoryview(out).cast("B")
+        frame_bytes = 4 * out.shape[1]
+        offset = start * frame_bytes
+        nbytes = 0
+        # preadv may return fewer bytes than requested, e.g. for large
+        # reads or on network filesystems; 0 bytes means end of file
+        while nbytes < len(view):
+            got = os.preadv(fd, [view[nbytes:]], offset + nbytes)
+            if got == 0:
+                break
+            nbytes += got
+        return nbytes // frame_bytes
+
+    def _read(
+        self, start: int, stop: int, out: np.ndarray, scratch: list
+    ) -> np.ndarray:
+        n = min(stop, len(self)) - start
+        if n <= 0:
+            return out[:0]
+        if len(self.fds) == 1:
+            return out[: self._read_file(self.fds[0], start, out[:n])]
+        # every file fills its own columns of the block
+        offset = 0
+        for fd, channels, buf in zip(
+            self.fds, self.file_channels, scratch, strict=True
+        ):
+            n = min(n, self._read_file(fd, start, buf[:n]))
+            out[:n, offset : offset + channels] = buf[:n]
+            offset += channels
+        return out[:n]
+
+    def _scratch(self, frames: int) -> list:
+        """Per-file read buffers of a block; not needed for a single file."""
+        if len(self.file_channels) == 1:
+            return []
+        return [
+            np.empty((frames, channels), dtype=np.float32)
+            for channels in self.file_channels
+        ]
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        start, stop, step = rows.indices(len(self))
+        stop = max(start, stop)
+        self.open()
+        out = self._read(
+            start,
+            stop,
+            np.empty((stop - start, self.channels), dtype=np.float32),
+            self._scratch(stop - start),
+        )
+        return out[::step, cols]
+
+    def blocks(self, block_size: int, noverlap: int = 0):
+        """Iterate over the data in blocks of block_size samples.
 
         Parameters
         ----------
-        audio_loader : aio.AudioLoader
-            An instance of the AudioLoader class for loading audio data.
         block_size : int
-            The size of each data block to be loaded.
+            Number of samples per block.
         noverlap : int, optional
-            Number of overlapping samples between blocks, by default 0.
+            Number of samples successive blocks overlap, by default 0.
+
+        Yields
+        ------
+        block : 2d-array
+            Block of data, samples x channels.
         """
-        self.data_loader = data_loader
-        self.block_size = block_size
-        self.noverlap = noverlap
-        self.nblocks = len(self.data_loader) // (block_size - noverlap)
+        if noverlap >= block_size:
+            msg = (
+                f"noverlap={noverlap} must be smaller than "
+                f"block_size={block_size}"
+            )
+            raise ValueError(msg)
+        self.open()
+        step = block_size - noverlap
+        starts = range(0, max(len(self) - noverlap, 1), step)
+        bounds = [(i0, min(i0 + block_size, len(self))) for i0 in starts]
+
+        if len(bounds) == 1:
+            # a single block is read directly, no read-ahead needed
+            yield self[bounds[0][0] : bounds[0][1]]
+            return
+
+        bufs = [
+            (
+                np.empty((block_size, self.channels), dtype=np.float32),
+                self._scratch(block_size),
+            )
+            for _ in range(self.depth + 1)
+        ]
+        with ThreadPoolExecutor(max_workers=self.depth) as pool:
+            pending = deque()
+            for k, (i0, i1) in enumerate(bounds):
+                buf, scratch = bufs[k % len(bufs)]
+                pending.append(pool.submit(self._read, i0, i1, buf, scratch))
+                if len(pending) > self.depth:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+def raw_trace_files(data):
+    """
+    The float32 .raw files of a fishgrid or relacs recording opened by a thunderlab DataLoader and the channels each
+    of them holds: one traces-gridN.raw file per grid for fishgrid, one trace-K.raw file per channel for relacs.
 
-    def __iter__(self):
-        with self.data_loader as data:
-            for block in data.blocks(self.block_size, self.noverlap):
-                yield torch.from_numpy(block).to(device)
+    Parameters
+    ----------
+        data : thunderlab.dataloader.DataLoader
+            Opened recording.
 
-    def __len__(self):
-        return len(self.data_loader)
+    Returns
+    -------
+        files : list of tuple or None
+            Path and channel count of every .raw file, in the order of the channels. None if the recording is not
+            stored in such files or the size of a file does not match the shape of the recording.
+    """
+    data_format = getattr(data, "format", None)
+    paths = getattr(data, "trace_filepaths", [])
+    if data_format == "FISHGRID":
+        file_channels = getattr(data, "grid_channels", [])
+    elif data_format == "RELACS":
+        file_channels = [1] * len(paths)
+    else:
+        return None
+    if not paths or len(paths) != len(file_channels):
+        return None
+    if sum(file_channels) != data.channels:
+        return None
+
+    frames = data.shape[0]
+    for path, channels in zip(paths, file_channels, strict=True):
+        if os.fspath(path).endswith(".gz"):
+            return None
+        size = os.path.getsize(path)
+        if len(paths) == 1:
+            if size != frames * channels * 4:
+                return None
+        # the files of one recording may differ by a frame or two, the
+        # recording ends with the shortest one
+        elif size % (channels * 4) or size // (channels * 4) < frames:
+            return None
+    return list(zip(paths, file_channels, strict=True))
+
+
+def make_torch_loader(
+    dataset, num_workers: int = 2, prefetch_factor: int = 2
+):
+    """
+    Wraps a MultiChannelAudioDataset in a torch DataLoader that reads upcoming blocks in worker processes while
+    the current block is analysed. Blocks arrive in order, in pinned host memory when a GPU is available, and have
+    to be moved to the device by the consumer, e.g. with block.to(device, non_blocking=True).
+
+    Parameters
+    ----------
+        dataset : MultiChannelAudioDataset
+            Dataset providing the data blocks.
+        num_workers : int
+            Number of worker processes reading blocks. If 0, blocks are read in the main process without prefetching.
+        prefetch_factor : int
+            Number of blocks each worker loads in advance.
+
+    Returns
+    -------
+        loader : torch.utils.data.DataLoader
+            Iterable over the data blocks of dataset.
+    """
+    import multiprocessing
+
+    import torch
 
-    @property
-    def shape(self):
-        return self.data_loader.shape
+    from .dataset import _worker_init_fn
+
+    if num_workers == 0:
+        return torch.utils.data.DataLoader(dataset, batch_size=None)
+
+    # forked workers inherit the dataset instead of unpickling it, the open
+    # data loader is then replaced in _worker_init_fn
+    context = (
+        "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+    )
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=None,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor,
+        pin_memory=_gpu_available(),
+        worker_init_fn=_worker_init_fn,
+        multiprocessing_context=context,
+    )
 
 
 def open_raw_data(
@@ -106,6 +349,7 @@ def open_raw_data(
     backsize: float = 0.0,
     channel: int = -1,
     snippet_size: int = 2**21,
+    raw_readahead: int = 0,
     verbose: int = 0,
     logger=None,
     **kwargs: dict,
@@ -127,6 +371,10 @@ def open_raw_data(
             The single channel to be worked on or all channels if negative.
         snippet_size : int
             Sample count that is contained in one data snippet handled by the respective spectogram functions at once.
+        raw_readahead : int
+            If > 0 and the recording is stored in float32 .raw files (fishgrid or relacs, see raw_trace_files), data
+            is provided by a RawBlockReader that keeps this many block reads in flight. Otherwise the thunderlab
+            DataLoader is used.
         verbose : int
             Verbosity level regulating shell/logging feedback during analysis. Suggested for debugging in development.
         logger : object
@@ -164,6 +412,11 @@ def open_raw_data(
     channels = data.channels
     shape = data.shape
 
+    files = raw_trace_files(data) if raw_readahead > 0 else None
+    if files is not None and hasattr(os, "preadv"):
+        data.close()
+        data = RawBlockReader(files, samplerate, shape[0], depth=raw_readahead)
+
     if verbose >= 1:
         logger.info(f"Loading data from: {os.path.abspath(folder)}")
 
@@ -174,9 +427,13 @@ def main(args):
     # if args.verbose >= 1:
     # print("\n--- Running wavetracker.datahandler ---")
 
+    import matplotlib.pyplot as plt
+
+    from .dataset import MultiChannelAudioDataset
+
     cfg = Configuration(args.config, verbose=args.verbose)
 
-    data, samplerate, channels, dataset, data_shape = open_raw_data(
+    data, samplerate, channels, data_shape = open_raw_data(
         filename=args.file, verbose=args.verbose, **cfg.spectrogram
     )
 
@@ -188,12 +445,26 @@ def main(args):
         sharey="all",
     )
     ax = np.hstack(ax)
-    d = data[0 : cfg.spectrogram["snippet_size"], :]
+    files = None if isinstance(data, RawBlockReader) else raw_trace_files(data)
+    if files is not None and len(files) == 1:
+        # a single .raw file holding all channels (its size is checked in
+        # raw_trace_files); map the file instead of filling the DataLoader
+        # buffer for a single plot
+        raw = np.memmap(
+            files[0][0], dtype=np.float32, mode="r", shape=tuple(data_shape)
+        )
+        d = raw[0 : cfg.spectrogram["snippet_size"], :]
+    else:
+        d = data[0 : cfg.spectrogram["snippet_size"], :]
     fig.suptitle("Data loaded with thunderfish.DataLoader")
+    snippet_size = cfg.spectrogram["snippet_size"]
+    # float32 time axis, computed once and shifted per snippet
+    t0 = np.arange(snippet_size, dtype=np.float32) / np.float32(samplerate)
+    t = t0[: len(d)]
+    # channels first, so that every plotted trace is contiguous in memory
+    d_soa = np.ascontiguousarray(d.T)
     for i in range(channels):
-        ax[i].plot(
-            np.arange(cfg.spectrogram["snippet_size"]) / samplerate, d[:, i]
-        )
+        ax[i].plot(t, d_soa[i])
         ax[i].text(
             0.9,
             0.9,
@@ -204,8 +475,10 @@ def main(args):
         )
     plt.show()
 
-    if available_GPU:
-        for enu, data in enumerate(dataset.take(2)):
+    if _gpu_available():
+        dataset = MultiChannelAudioDataset(data, snippet_size)
+        loader = make_torch_loader(dataset)
+        for enu, block in enumerate(itertools.islice(loader, 2)):
             fig, ax = plt.subplots(
                 int(np.ceil(data_shape[1] / 2)),
                 2,
@@ -214,17 +487,11 @@ def main(args):
                 sharey="all",
             )
             ax = np.hstack(ax)
-            d = data.numpy()
-            fig.suptitle("Data loaded with tensorflow.generator")
+            d = block.cpu().numpy().astype(np.float32, copy=False)
+            t = t0[: len(d)] + np.float32(enu * snippet_size / samplerate)
+            fig.suptitle("Data loaded with MultiChannelAudioDataset")
             for i in range(channels):
-                ax[i].plot(
-                    (
-                        np.arange(cfg.spectrogram["snippet_size"])
-                        + enu * cfg.spectrogram["snippet_size"]
-                    )
-                    / samplerate,
-                    d[:, i],
-                )
+                ax[i].plot(t, d[:, i])
                 ax[i].text(
                     0.9,
                     0.9,
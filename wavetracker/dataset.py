@@ -0,0 +1,278 @@
+import numpy as np
+import torch
+from thunderlab.dataloader import DataLoader
+
+from wavetracker.device_check import get_device
+
+
+class MultiChannelAudioDataset(torch.utils.data.IterableDataset):
+    """Iterator for loading data from a multi-channel audio file.
+
+    Yielded blocks are tensors of shape (samples, channels), float32 unless a
+    reduced precision dtype is requested for the GPU. They share memory with
+    reused buffers (or, on the CPU, with the loader's own buffer when the
+    block is C-contiguous float32) and are only valid until the next block
+    is requested.
+    """
+
+    RING_SIZE = 3
+    """Number of host (and device) buffers that are filled in turn."""
+
+    DTYPES = {"float32": torch.float32, "float16": torch.float16}
+    """Supported dtypes of the yielded tensors (torch.stft rejects bfloat16)."""
+
+    def __init__(
+        self,
+        data_loader: DataLoader,
+        block_size: int,
+        noverlap: int = 0,
+        dtype: str | torch.dtype = torch.float32,
+        stream: "torch.cuda.Stream | None" = None,
+    ) -> None:
+        """Initialize the iterator for loading data from a multi-channel audio.
+
+        Parameters
+        ----------
+        audio_loader : aio.AudioLoader
+            An instance of the AudioLoader class for loading audio data.
+        block_size : int
+            The size of each data block to be loaded.
+        noverlap : int, optional
+            Number of overlapping samples between blocks, by default 0.
+        dtype : str or torch.dtype, optional
+            Dtype of the yielded tensors, "float32" or "float16" (halves host
+            to device traffic). Reduced precision is only used on CUDA
+            devices, by default torch.float32.
+        stream : torch.cuda.Stream, optional
+            CUDA stream on which blocks are copied to the device, so that the
+            copy of the next block overlaps with the work on the current one
+            (see to_device), by default the current stream is used.
+        """
+        if isinstance(dtype, str):
+            if dtype not in self.DTYPES:
+                msg = (
+                    f"Unsupported dtype {dtype!r}, "
+                    f"expected one of {sorted(self.DTYPES)}"
+                )
+                raise ValueError(msg)
+            dtype = self.DTYPES[dtype]
+        elif dtype not in self.DTYPES.values():
+            msg = f"Unsupported dtype {dtype}"
+            raise ValueError(msg)
+        # resolved here rather than at import, so importing the module does
+        # not initialize CUDA
+        self.device = get_device()
+        if self.device.type != "cuda":
+            dtype = torch.float32
+        self.dtype = dtype
+
+        self.data_loader = data_loader
+        self.block_size = block_size
+        self.noverlap = noverlap
+        # number of blocks the iteration yields (the last one may be shorter)
+        self.nblocks = len(
+            range(
+                0,
+                max(len(self.data_loader) - noverlap, 1),
+                block_size - noverlap,
+            )
+        )
+
+        # a ring of page-locked host buffers and matching device buffers that
+        # are filled in turn, so that the asynchronous host to device copy of
+        # one block can overlap with reading the next one and no device
+        # memory is allocated per block. Without CUDA they only receive
+        # blocks that cannot be wrapped as they are (non-contiguous or not
+        # float32).
+        # float16 blocks are already converted on the host, so only half the
+        # bytes are transferred.
+        self._pinned = self.device.type == "cuda"
+        self._host_dtype = self.dtype
+        # both rings are allocated on first use in the main process: forked
+        # loader workers never touch CUDA memory, and a dataset consumed
+        # through a DataLoader does not lock host memory it never fills.
+        # Events mark when the upload into a device slot is done (_ready)
+        # and when the work queued on it has finished (_free).
+        self._bufs = None
+        self._dev_bufs = None
+        self._ready = None
+        self._free = None
+        self.stream = stream
+
+        # the loader stays open for the lifetime of the dataset, so repeated
+        # iterations reuse its file handle and internal buffer
+        self._data = self.data_loader.__enter__()
+
+    def __iter__(self):
+        if self._data is None:
+            self._data = self.data_loader.__enter__()
+        worker = torch.utils.data.get_worker_info()
+        if worker is not None:
+            yield from self._iter_worker(worker.id, worker.num_workers)
+            return
+        blocks = self._data.blocks(self.block_size, self.noverlap)
+        if self._pinned:
+            yield from self.to_device(self._fill_host_ring(blocks))
+            return
+        for i, block in enumerate(blocks):
+            if block.dtype == np.float32 and block.flags["C_CONTIGUOUS"]:
+                # wraps the loader's memory without a copy (on the CPU)
+                yield torch.from_numpy(block).to(self.device)
+                continue
+            yield self._fill_host_buf(i % self.RING_SIZE, block)
+
+    def _fill_host_buf(self, k: int, block: np.ndarray) -> torch.Tensor:
+        """Copy a block into host ring slot k."""
+        if self._bufs is None:
+            self._bufs = [
+                torch.empty(
+                    (self.block_size, self.data_loader.channels),
+                    dtype=self._host_dtype,
+                    pin_memory=self._pinned,
+                )
+                for _ in range(self.RING_SIZE)
+            ]
+        buf = self._bufs[k][: len(block)]
+        np.copyto(buf.numpy(), block)
+        return buf
+
+    def _fill_host_ring(self, blocks):
+        """Copy blocks into the pinned host ring, in turn."""
+        for i, block in enumerate(blocks):
+            k = i % self.RING_SIZE
+            # the upload of the block previously held by slot k must be done
+            # before the slot is refilled
+            self._ready[k].synchronize()
+            yield self._fill_host_buf(k, block)
+
+    def _upload(self, block, k: int, stream: "torch.cuda.Stream"):
+        """Queue the copy of a host block into device ring slot k on stream."""
+        if block is None:
+            return None
+        dev_buf = self._dev_bufs[k][: len(block)]
+        # slot k must not be overwritten before the work the consumer queued
+        # on its previous block is done
+        stream.wait_event(self._free[k])
+        with torch.cuda.stream(stream):
+            dev_buf.copy_(block, non_blocking=True)
+        self._ready[k].record(stream)
+        return dev_buf
+
+    def to_device(self, blocks):
+        """Move host blocks, e.g. from a DataLoader, to the device.
+
+        On CUDA every block is copied into a ring of preallocated device
+        buffers. The copy of the next block is queued on the dataset's
+        stream before the current block is yielded, so it overlaps with the
+        work on the current block; the current stream only waits for a copy
+        when its block is consumed. Without a stream the copies are queued
+        on the current stream.
+
+        Parameters
+        ----------
+        blocks : iterable of torch.Tensor
+            Host blocks, ideally in pinned memory for asynchronous copies.
+
+        Yields
+        ------
+        block : torch.Tensor
+            The block on the device, in the dataset's dtype. It shares memory
+            with the device ring and is only valid until the next block is
+            requested.
+        """
+        if self.device.type != "cuda":
+            for block in blocks:
+                yield block.to(self.device, self.dtype)
+            return
+
+        current = torch.cuda.current_stream()
+        stream = current if self.stream is None else self.stream
+        if self._dev_bufs is None:
+            # device buffers are allocated on first use in the main process,
+            # so that forked loader workers never touch CUDA memory
+            with torch.cuda.stream(stream):
+                self._dev_bufs = [
+                    torch.empty(
+                        (self.block_size, self.data_loader.channels),
+                        dtype=self.dtype,
+                        device=self.device,
+                    )
+                    for _ in range(self.RING_SIZE)
+                ]
+            self._ready = [torch.cuda.Event() for _ in range(self.RING_SIZE)]
+            self._free = [torch.cuda.Event() for _ in range(self.RING_SIZE)]
+
+        blocks = iter(blocks)
+        k = 0
+        dev_buf = self._upload(next(blocks, None), k, stream)
+        while dev_buf is not None:
+            current.wait_event(self._ready[k])
+            dev_buf.record_stream(current)
+            nxt = (k + 1) % self.RING_SIZE
+            # queued before the consumer works on the current block
+            pending = self._upload(next(blocks, None), nxt, stream)
+            yield dev_buf
+            self._free[k].record(current)
+            dev_buf, k = pending, nxt
+
+    def _iter_worker(self, worker_id: int, num_workers: int):
+        """Yield every num_workers-th block, starting at block worker_id.
+
+        Used inside torch.utils.data.DataLoader worker processes. Blocks are
+        returned as fresh host tensors, since they are passed on to the main
+        process through shared memory; moving them to the device is left to
+        the consumer. The DataLoader interleaves the workers' outputs, so the
+        blocks arrive in their original order.
+        """
+        step = self.block_size - self.noverlap
+        for i0 in range(
+            worker_id * step,
+            max(len(self._data) - self.noverlap, 1),
+            num_workers * step,
+        ):
+            block = self._data[i0 : i0 + self.block_size]
+            yield torch.tensor(block, dtype=self._host_dtype)
+
+    def worker_init(self):
+        """Give a DataLoader worker process its own handle on the data.
+
+        Forked workers inherit the open files of the parent process and share
+        their read offsets, so a thunderlab DataLoader is reopened. The
+        RawBlockReader only uses positional reads and can be shared as is.
+        """
+        loader = self.data_loader
+        if isinstance(loader, DataLoader):
+            paths = loader.file_paths
+            self.data_loader = DataLoader(
+                [str(p) for p in paths] if len(paths) > 1 else str(paths[0]),
+                buffersize=loader.bufferframes / loader.rate,
+                backsize=loader.backframes / loader.rate,
+            )
+        self._data = self.data_loader.__enter__()
+
+    def __getstate__(self):
+        # open handles are not shared with worker processes; the loader is
+        # re-entered on the first iteration in the worker
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Close the underlying data loader."""
+        if getattr(self, "_data", None) is not None:
+            self.data_loader.__exit__(None, None, None)
+            self._data = None
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    @property
+    def shape(self):
+        return self.data_loader.shape
+
+
+def _worker_init_fn(worker_id: int) -> None:
+    torch.utils.data.get_worker_info().dataset.worker_init()
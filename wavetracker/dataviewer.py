@@ -335,8 +335,11 @@ class DataViewer(QWidget):
         x_idx_0 = int(obj.data_x_min * self.data.samplerate)
         x_idx_1 = int(obj.data_x_max * self.data.samplerate)
         if not self.force_update_spec_plot:
+            # one contiguous channels x samples array, so the FFT can run
+            # batched over channels
             self.Spec.snippet_spectrogram(
-                self.data[x_idx_0:x_idx_1, :].T, obj.data_x_min
+                np.ascontiguousarray(self.data[x_idx_0:x_idx_1, :].T),
+                obj.data_x_min,
             )
         self.force_update_spec_plot = False
         obj.plot_handels[0].setImage(
@@ -362,14 +365,17 @@ class DataViewer(QWidget):
         x_idx_1 = int(obj.data_x_max * self.data.samplerate)
 
         if not self.force_update_spec_plot:
+            # one contiguous channels x samples array, so the FFT can run
+            # batched over channels
             self.Spec.snippet_spectrogram(
-                self.data[x_idx_0:x_idx_1, :].T, obj.data_x_min
+                np.ascontiguousarray(self.data[x_idx_0:x_idx_1, :].T),
+                obj.data_x_min,
             )
         self.force_update_spec_plot = False
 
         for ch in range(self.data.channels):
             obj.plot_handels[ch].setImage(
-                decibel(self.Spec.spec[ch, :, :].T),
+                decibel(self.Spec.channel_spec(ch)),
                 levels=[self.v_min, self.v_max],
                 colorMap="viridis",
             )
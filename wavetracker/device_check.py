@@ -1,7 +1,10 @@
-import torch
+from typing import TYPE_CHECKING
 
+if TYPE_CHECKING:
+    import torch
 
-def get_device() -> torch.device:
+
+def get_device() -> "torch.device":
     """Check if a CUDA-enabled GPU is available, and return the correct device.
 
     Returns
@@ -13,6 +16,8 @@ def get_device() -> torch.device:
         device object representing that GPU.
         Otherwise, returns a device object representing the CPU.
     """
+    import torch
+
     if torch.cuda.is_available() is True:
         device = torch.device("cuda")  # nvidia / amd gpu
     elif torch.backends.mps.is_available() is True:
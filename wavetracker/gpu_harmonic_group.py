@@ -443,8 +443,68 @@ def get_fundamentals(assigned_hg, spec_freq):
     return f_list
 
 
+def get_fundamentals_flat(assigned_hg, spec_freq):
+    """
+    Fundamentals of all time bins at once, as flat arrays in the order of get_fundamentals(). The fundamental of a
+    harmonic group is its lowest frequency bin.
+
+    Parameters
+    ----------
+        assigned_hg : 2d-array
+            Harmonic group of every frequency bin (time bins x frequencies, 0 for none).
+        spec_freq : 1d-array
+            Frequencies of the spectrogram.
+
+    Returns
+    -------
+        fund : 1d-array
+            Fundamental frequencies.
+        t_idx : 1d-array
+            Time bin of each fundamental.
+        f_idx : 1d-array
+            Frequency bin of each fundamental.
+    """
+    t, f = np.nonzero(assigned_hg)
+    labels = assigned_hg[t, f].astype(np.int64)
+    # one key per (time bin, group); nonzero is row-major, so the first
+    # occurrence of a key is the lowest frequency bin of the group
+    n_labels = int(labels.max()) + 1 if len(labels) else 1
+    keys, first = np.unique(t * n_labels + labels, return_index=True)
+    f_idx = f[first]
+    t_idx = (keys // n_labels).astype(np.int32)
+    return spec_freq[f_idx], t_idx, f_idx
+
+
 # def harmonic_group_pipeline(spec_arr, spec_freq_arr, cfg, verbose = 0):
-def harmonic_group_pipeline(spec_arr, spec_freq_arr, cfg, verbose=0):
+def harmonic_group_pipeline(
+    spec_arr, spec_freq_arr, cfg, verbose=0, log_spec=None
+):
+    """
+    Detects harmonic groups in all time bins of a spectrogram on the GPU.
+
+    Parameters
+    ----------
+        spec_arr : 2d-array
+            Power spectrogram (frequencies x time bins).
+        spec_freq_arr : 1d-array
+            Frequencies of the spectrogram.
+        cfg : object
+            Configuration; the harmonic_groups section holds the parameters.
+        verbose : int
+            Verbosity level.
+        log_spec : 2d-array, optional
+            Contiguous float32 buffer (time bins x frequencies) the decibel spectrogram is written to, e.g. a slice of
+            Spectrogram.log_scratch reused for every snippet (default in None, i.e. a new array is allocated).
+
+    Returns
+    -------
+        assigned_hg : 2d-array
+            Harmonic group of every peak (time bins x frequencies, 0 for none).
+        peaks : 2d-array
+            Detected peaks (2 for peaks used in harmonic groups).
+        log_spec : 2d-array
+            Decibel spectrogram (time bins x frequencies).
+    """
     ### logaritmic spec ###
 
     # CPU arrays (pinned)
@@ -452,10 +512,8 @@ def harmonic_group_pipeline(spec_arr, spec_freq_arr, cfg, verbose=0):
         (spec_arr.shape[1], spec_arr.shape[0]), dtype=np.float32
     )
     spec[:, :] = spec_arr.transpose()[:, :]
-    log_spec = cuda.pinned_array_like(spec)
-    log_spec = np.zeros_like(
-        log_spec
-    )  # TODO: This is now a numpy array again, not a pinned array
+    if log_spec is None:
+        log_spec = np.empty_like(spec)
 
     # GPU arrays
     g_spec = cuda.to_device(spec)
@@ -551,9 +609,9 @@ def harmonic_group_pipeline(spec_arr, spec_freq_arr, cfg, verbose=0):
     spec_freq = cuda.pinned_array_like(spec_freq_arr)
     spec_freq[:] = spec_freq_arr[:]
 
-    # GPU arrays
-    g_peaks = cuda.device_array_like(g_log_spec)
-    g_troughs = cuda.device_array_like(g_log_spec)
+    # GPU arrays; zeroed, the kernel only marks peaks and troughs
+    g_peaks = cuda.to_device(peaks)
+    g_troughs = cuda.to_device(troughs)
     g_spec_freq = cuda.to_device(spec_freq)
     # g_low_th = cuda.to_device(low_th)
     # g_high_th = cuda.to_device(high_th)
@@ -5,6 +5,7 @@ from functools import partial
 
 import gc
 import numpy as np
+import scipy.fft
 import torch
 from matplotlib.mlab import specgram as mspecgram
 from scipy.signal.windows import hann
@@ -15,6 +16,7 @@ from wavetracker.logger import get_logger, get_progress
 
 from .config import Configuration
 from .datahandler import open_raw_data
+from .dataset import MultiChannelAudioDataset
 
 device = get_device()
 available_GPU = False if device.type == "cpu" else True
@@ -142,6 +144,30 @@ def get_step_and_overlap(overlap_frac, nfft, **kwargs):
 #     return ret_spectra, freqs, times
 
 
+@torch.jit.script
+def scaled_power(stft: torch.Tensor, scale: float) -> torch.Tensor:
+    """
+    Computes the scaled power of a complex spectrogram in a single fused elementwise pass, i.e. without the square
+    root and re-squaring of abs(stft)**2 and without materializing the intermediate magnitudes. Reduced precision
+    input is promoted to float32, since the squared and scaled powers underflow in float16.
+
+    Parameters
+    ----------
+        stft : tensor
+            Complex spectrogram.
+        scale : float
+            Factor applied to the power.
+
+    Returns
+    -------
+        power : tensor
+            Scaled float32 power spectrogram.
+    """
+    re = stft.real.float()
+    im = stft.imag.float()
+    return (re * re + im * im) * scale
+
+
 def pytorch_spec(data, data_overlap, samplerate, nfft, step, **kwargs):
     """
     Computes a spectrogram for a data snippet with n samples recorded on m channels, including edge tapering
@@ -171,30 +197,8 @@ def pytorch_spec(data, data_overlap, samplerate, nfft, step, **kwargs):
         times : 1d-array
             Time array corresponding to the 1st dimension of the computed spectrogram.
     """
-
-    def conversion_to_old_scale(torch_spectrogram):
-        """
-        Scales the spectrogram computed using the PyTorch functionality to match the scale of the old way described
-        in the function mlab_spec().
-
-        Parameters
-        ----------
-            torch_spectrogram : 2d-tensor
-                Spectrogram
-
-        Returns
-        -------
-            scaled_spectrogram : 2d-tensor
-                Scaled spectrogram that matches the range of spectrograms returned by mlab_spec.
-
-        """
-        scaled_spectrogram = (
-            torch_spectrogram**2 * 4.05e-9
-        )  # Adjust based on calibration
-        return scaled_spectrogram
-
     # Create Hann window for STFT
-    stft_window = torch.tensor(hann(nfft), dtype=torch.float32, device=device)
+    stft_window = torch.tensor(hann(nfft), dtype=data.dtype, device=device)
 
     # Compute the short-time Fourier transform (STFT)
     stft = torch.stft(
@@ -206,18 +210,16 @@ def pytorch_spec(data, data_overlap, samplerate, nfft, step, **kwargs):
         return_complex=True,
     )
 
-    # Compute magnitude of the STFT
-    spectra = torch.abs(stft)
-
     # Truncate the spectrogram to remove overlaps
     if data_overlap > 0:
         overlap_frames = data_overlap // step  # overlap from samples to STFT
         start_frame = overlap_frames // 2
-        end_frame = spectra.shape[-1] - (overlap_frames - overlap_frames // 2)
-        spectra = spectra[:, :, start_frame:end_frame]
+        end_frame = stft.shape[-1] - (overlap_frames - overlap_frames // 2)
+        stft = stft[:, :, start_frame:end_frame]
 
-    # Apply scaling
-    ret_spectra = conversion_to_old_scale(spectra)
+    # Power of the STFT, scaled to match the range of spectrograms returned
+    # by mlab_spec (adjust based on calibration)
+    ret_spectra = scaled_power(stft, 4.05e-9)
 
     # Create frequency and time axes
     freqs = np.fft.rfftfreq(nfft, 1 / samplerate)
@@ -245,6 +247,79 @@ def pytorch_spec(data, data_overlap, samplerate, nfft, step, **kwargs):
     return ret_spectra, freqs, times
 
 
+def scipy_spec(
+    data, data_overlap, samplerate, nfft, step, window=None, **kwargs
+):
+    """
+    CPU counterpart of pytorch_spec(): computes the spectrogram of a data snippet recorded on m channels with the
+    same framing (centered, reflect-padded windows), overlap truncation, and scaling. The FFTs of all windows of a
+    channel are computed in one batched, multithreaded scipy.fft call; channels are processed in turn, which bounds
+    the memory of the windowed frames to one channel.
+
+    Parameters
+    ----------
+        data : 2d-array
+            Contains a snippet of raw data from electrode (grid) recordings of electric fish. Data shape resembles
+            channels (1st dimension) x samples (2nd dimension).
+        data_overlap : int
+            Samples the snippet overlaps with its neighbours; the corresponding windows are removed.
+        samplerate : int
+            Samplerate of the data.
+        nfft : int
+            Samples in one nfft window.
+        step : int
+            Samples by which consecutive nfft windows are shifted by.
+        window : 1d-array, optional
+            Window of nfft samples, by default a Hann window. Pass a precomputed window to avoid recomputing it for
+            every snippet.
+        kwargs : dict
+            Excess parameters from the configuration dictionary passed to the function.
+
+    Returns
+    -------
+        ret_spectra : 3d-array
+            Float32 spectrogram computed for the given data (channels x frequencies x times).
+        freqs : 1d-array
+            Frequency array corresponding to the 2nd dimension of the computed spectrogram.
+        times : 1d-array
+            Time array corresponding to the 3rd dimension of the computed spectrogram.
+    """
+    if window is None:
+        window = hann(nfft).astype(np.float32)
+    data = np.asarray(data, dtype=np.float32)
+
+    padded = np.pad(data, ((0, 0), (nfft // 2, nfft // 2)), mode="reflect")
+    frames = np.lib.stride_tricks.sliding_window_view(padded, nfft, axis=-1)[
+        :, ::step
+    ]
+
+    # Truncate the spectrogram to remove overlaps
+    if data_overlap > 0:
+        overlap_frames = data_overlap // step  # overlap from samples to STFT
+        start_frame = overlap_frames // 2
+        end_frame = frames.shape[1] - (overlap_frames - overlap_frames // 2)
+        frames = frames[:, start_frame:end_frame]
+
+    # Power scaled as in pytorch_spec(), frequencies as 2nd dimension
+    ret_spectra = np.empty(
+        (frames.shape[0], nfft // 2 + 1, frames.shape[1]), dtype=np.float32
+    )
+    for channel in range(frames.shape[0]):
+        stft = scipy.fft.rfft(frames[channel] * window, axis=-1, workers=-1)
+        np.multiply(
+            (stft.real**2 + stft.imag**2).T, 4.05e-9, out=ret_spectra[channel]
+        )
+
+    freqs = np.fft.rfftfreq(nfft, 1 / samplerate)
+    times = np.linspace(
+        0,
+        data.shape[-1] / samplerate,
+        ret_spectra.shape[-1],
+        endpoint=False,
+    )
+    return ret_spectra, freqs, times
+
+
 def mlab_spec(
     data,
     samplerate,
@@ -363,12 +438,14 @@ class Spectrogram:
                 CPU core count that can be used for simultaneous spectrogram analysis of different channels in one
                 data-snippet.
             kwargs : dict
-                Excess parameters from the configuration dictionary passed to the function.
+                Excess parameters from the configuration dictionary passed to the function. A "gpu_use" entry selects
+                the GPU or CPU pathway (by default the GPU if available).
         """
         self.save_path = folder
         self.verbose = verbose
+        # gpu_use is not forwarded to the spectrogram functions
+        self.gpu = kwargs.pop("gpu_use", available_GPU)
         self.kwargs = kwargs
-        self.gpu = True
 
         # spectrogram parameters
         self.snippet_size = snippet_size
@@ -381,6 +458,10 @@ class Spectrogram:
         self.data_shape = data_shape
         self.step = step
         self.noverlap = noverlap
+        # window of the CPU spectrogram, computed once
+        self.window = hann(self.nfft).astype(np.float32)
+        # allocated on first use (see log_scratch)
+        self._log_scratch = None
 
         self.core_count = (
             multiprocessing.cpu_count() if not core_count else core_count
@@ -398,7 +479,10 @@ class Spectrogram:
         self.sum_spec = None
         self.spec_times = None
         self.spec_freqs = None
-        self.spec = None
+        # snippet spectrogram of all channels, laid out differently by the
+        # GPU and CPU pathway: only read through signal_powers and
+        # channel_spec
+        self._spec = None
 
         # additional tasks
         ### sparse spec
@@ -474,6 +558,17 @@ class Spectrogram:
                 )
         self.terminate = False
 
+    @property
+    def log_scratch(self):
+        """
+        Decibel spectrogram scratch (time x frequency) of the GPU harmonic group detection, sized for the longest
+        possible snippet. Only allocated when first used, and again when the fft parameters have changed.
+        """
+        shape = (self.snippet_size // self.step + 1, self.nfft // 2 + 1)
+        if self._log_scratch is None or self._log_scratch.shape != shape:
+            self._log_scratch = np.empty(shape, dtype=np.float32)
+        return self._log_scratch
+
     @property
     def overlap_frac(self):
         """
@@ -563,7 +658,7 @@ class Spectrogram:
                 Timeponit of the first datapoint in the data snippet in respect to the whole recording analized.
         """
         if self.gpu:
-            self.spec, self.spec_freqs, spec_times = pytorch_spec(
+            spec, self.spec_freqs, spec_times = pytorch_spec(
                 data=data_snippet,
                 data_overlap=self.snippet_overlap,
                 samplerate=self.samplerate,
@@ -572,40 +667,29 @@ class Spectrogram:
                 **self.kwargs,
             )
 
-            self.sum_spec = self.spec.sum(dim=0)
-            self.sum_spec = self.sum_spec.cpu().numpy()
-            self.spec = self.spec.cpu().numpy()
+            self.sum_spec = np.ascontiguousarray(
+                spec.sum(dim=0).cpu().numpy(), dtype=np.float32
+            )
+            # time x frequency x channel: the powers of a signal on all
+            # electrodes are adjacent in memory. Reordered on the device, so
+            # the host copy is contiguous.
+            self._spec = spec.permute(2, 1, 0).contiguous().cpu().numpy()
             self.itter_count += 1
 
-        # else:
-        #     self.step, self.noverlap = get_step_and_overlap(
-        #         self._overlap_frac, self.nfft
-        #     )
-        #     self.partial_func = partial(
-        #         mlab_spec,
-        #         samplerate=self.samplerate,
-        #         nfft=self.nfft,
-        #         noverlap=self.noverlap,
-        #     )
-        #     pool = multiprocessing.Pool(self.core_count - 1)
-        #     a = pool.map(
-        #         self.partial_func, data_snippet
-        #     )  # ret: spec, freq, time
-        #     self.spec = np.array([a[channel][0] for channel in range(len(a))])
-        #     self.spec_freqs = a[0][1]
-        #     spec_times = a[0][2]
-        #     pool.terminate()
-        #     # self.spec_times = spec_times + (i0 / self.samplerate)
-        #     self.sum_spec = np.sum(self.spec, axis=0)
-        #     # fig, ax = plt.subplots(1, 1)
-        #     # ax.pcolormesh(
-        #     #     spec_times,
-        #     #     self.spec_freqs,
-        #     #     self.sum_spec,
-        #     #     cmap="jet",
-        #     #     shading="auto",
-        #     # )
-        #     # plt.show()
+        else:
+            spec, self.spec_freqs, spec_times = scipy_spec(
+                data=data_snippet,
+                data_overlap=self.snippet_overlap,
+                samplerate=self.samplerate,
+                step=self.step,
+                nfft=self.nfft,
+                window=self.window,
+                **self.kwargs,
+            )
+            self.sum_spec = spec.sum(axis=0)
+            # channel x frequency x time, as computed
+            self._spec = spec
+            self.itter_count += 1
 
         self.spec_times = spec_times + snipptet_t0
         self.times = np.concatenate((self.times, self.spec_times))
@@ -636,6 +720,44 @@ class Spectrogram:
         if self.terminate:
             self.save()
 
+    def signal_powers(self, t_idx, f_idx):
+        """
+        Powers of signals on all recording channels in the current snippet spectrogram.
+
+        Parameters
+        ----------
+            t_idx : 1d-array
+                Time indices of the signals in the snippet spectrogram.
+            f_idx : 1d-array
+                Frequency indices of the signals in the snippet spectrogram.
+
+        Returns
+        -------
+            powers : 2d-array
+                Powers of each signal (1st dimension) on each channel (2nd dimension).
+        """
+        if self.gpu:
+            return self._spec[t_idx, f_idx, :]
+        return self._spec[:, f_idx, t_idx].T
+
+    def channel_spec(self, channel):
+        """
+        Snippet spectrogram of a single recording channel.
+
+        Parameters
+        ----------
+            channel : int
+                Index of the recording channel.
+
+        Returns
+        -------
+            spec : 2d-array
+                Spectrogram of the channel with time as 1st and frequency as 2nd dimension.
+        """
+        if self.gpu:
+            return self._spec[:, :, channel]
+        return self._spec[channel].T
+
     def create_plotable_spec(self):
         """
         Create a sparse/plottable spectrogram for the whole recording (not only a data snippet). This is done by
@@ -810,6 +932,37 @@ class Spectrogram:
         gc.collect()
 
 
+def cpu_spectrograms(Spec, data, starts):
+    """
+    Computes the snippet spectrograms of a recording on the CPU. Every snippet is copied into one preallocated,
+    contiguous float32 channels x samples buffer, so the FFT runs batched over channels without allocating a copy of
+    each snippet.
+
+    Parameters
+    ----------
+        Spec : Spectrogram
+            Spectrogram object computing and collecting the snippet spectrograms.
+        data : 2d-array
+            Recording, samples (1st dimension) x channels (2nd dimension).
+        starts : range
+            First sample of every snippet.
+    """
+    snippet_buf = np.empty(
+        (len(Spec.channel_list), Spec.snippet_size), dtype=np.float32
+    )
+    with get_progress() as pbar:
+        task = pbar.add_task("Spectrogram", total=len(starts))
+        for i0 in starts:
+            snippet_t0 = (i0 + Spec.snippet_overlap // 2) / Spec.samplerate
+            Spec.terminate = i0 == starts[-1]
+
+            snippet = data[i0 : i0 + Spec.snippet_size, Spec.channel_list]
+            snippet_data = snippet_buf[:, : len(snippet)]
+            np.copyto(snippet_data, snippet.T)
+            Spec.snippet_spectrogram(snippet_data, snipptet_t0=snippet_t0)
+            pbar.update(task, advance=1)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Evaluated electrode array recordings with multiple fish."
@@ -858,66 +1011,69 @@ def main():
     cfg = Configuration(args.config, verbose=args.verbose)
 
     # load data
-    data, samplerate, channels, dataset, data_shape = open_raw_data(
+    data, samplerate, channels, data_shape = open_raw_data(
         filename=args.file, verbose=args.verbose, **cfg.spectrogram
     )
 
+    # snippet size aligned to the fft windows, as in wavetracker()
+    usable_snippet_length = int(cfg.spectrogram["snippet_size"] * samplerate)
+    snippet_overlap = int(
+        cfg.spectrogram["snippet_overlap_frac"] * usable_snippet_length
+    )
+    step, noverlap = get_step_and_overlap(
+        overlap_frac=cfg.spectrogram["overlap_frac"],
+        nfft=cfg.spectrogram["nfft"],
+    )
+    snippet_size = compute_aligned_snippet_length(
+        usable_snippet_length + snippet_overlap, step, noverlap
+    )
+
     # Spectrogram
     Spec = Spectrogram(
-        samplerate,
-        data_shape,
+        samplerate=samplerate,
+        data_shape=data_shape,
+        snippet_size=snippet_size,
+        snippet_overlap=snippet_overlap,
+        nfft=cfg.spectrogram["nfft"],
+        overlap_frac=cfg.spectrogram["overlap_frac"],
+        step=step,
+        noverlap=noverlap,
+        channels=channels,
         folder=folder,
         verbose=args.verbose,
         gpu_use=not args.cpu and available_GPU,
-        **cfg.raw,
-        **cfg.spectrogram,
     )
     if args.renew:
         Spec._get_sparse_spec, Spec._get_fine_spec = True, True
 
-    if available_GPU and not args.cpu:
+    # snippets start every hop samples and overlap by snippet_overlap
+    hop = Spec.snippet_size - Spec.snippet_overlap
+    starts = range(0, max(data_shape[0] - Spec.snippet_overlap, 1), hop)
+
+    if Spec.gpu:
         if args.verbose >= 1:
             print(
                 f"{'Spectrogram (GPU)':^25}: -- fine spec: {Spec._get_fine_spec} -- plotable spec: {Spec._get_sparse_spec}"
             )
 
-        iterations = int(np.ceil(data_shape[0] / Spec.snippet_size))
+        dataset = MultiChannelAudioDataset(
+            data, Spec.snippet_size, noverlap=Spec.snippet_overlap
+        )
         with get_progress() as pbar:
-            task = pbar.add_task("Spectrogram", total=iterations)
-            for snippet_data in dataset:
-                # last run !
-                snippet_t0 = Spec.itter_count * Spec.snippet_size / samplerate
-                if data.shape[0] // Spec.snippet_size == Spec.itter_count:
-                    Spec.terminate = True
-
-                Spec.snippet_spectrogram(snippet_data, snipptet_t0=snippet_t0)
+            task = pbar.add_task("Spectrogram", total=len(starts))
+            for i0, snippet_data in zip(starts, dataset, strict=True):
+                snippet_t0 = (i0 + Spec.snippet_overlap // 2) / samplerate
+                Spec.terminate = i0 == starts[-1]
+                Spec.snippet_spectrogram(snippet_data.T, snipptet_t0=snippet_t0)
                 pbar.update(task, advance=1)
+        dataset.close()
 
     else:
         if args.verbose >= 1:
             print(
                 f"{'Spectrogram (CPU)':^25}: -- fine spec: {Spec._get_fine_spec} -- plotable spec: {Spec._get_sparse_spec}"
             )
-        for i0 in track(
-            np.arange(0, data.shape[0], Spec.snippet_size - Spec.noverlap),
-            description="File analysis.",
-        ):
-            snippet_t0 = i0 / samplerate
-
-            if (
-                data.shape[0]
-                // (Spec.snippet_size - Spec.noverlap)
-                * (Spec.snippet_size - Spec.noverlap)
-                == i0
-            ):
-                Spec.terminate = True
-
-            snippet_data = [
-                data[i0 : i0 + Spec.snippet_size, channel]
-                for channel in Spec.channel_list
-            ]
-            Spec.snippet_spectrogram(snippet_data, snipptet_t0=snippet_t0)
-
+        cpu_spectrograms(Spec, data, starts)
 
 if __name__ == "__main__":
     main()
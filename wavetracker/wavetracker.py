@@ -1,21 +1,22 @@
 import argparse
+import itertools
 import multiprocessing
 import os
 import time
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import gc
 import torch
 
 import numpy as np
 from rich.progress import Progress
-from thunderfish.harmonics import fundamental_freqs, harmonic_groups
 
 from wavetracker.config import Configuration
-from wavetracker.datahandler import MultiChannelAudioDataset, open_raw_data
+from wavetracker.datahandler import make_torch_loader, open_raw_data
+from wavetracker.dataset import MultiChannelAudioDataset
 from wavetracker.device_check import get_device
 from wavetracker.gpu_harmonic_group import (
-    get_fundamentals,
+    get_fundamentals_flat,
     harmonic_group_pipeline,
 )
 from wavetracker.logger import get_logger, get_progress, configure_logging
@@ -27,10 +28,42 @@ from wavetracker.spectrogram import (
 from wavetracker.tracking import freq_tracking_v6
 import typer
 
+# ahead-of-time compiled module (build_aot.py) first, then the JIT version
+try:
+    from wavetracker._wavetracker_hg import harmonic_groups_batch, noise_std
+except ImportError:
+    from wavetracker._hg_numba import harmonic_groups_batch, noise_std
+
 app = typer.Typer(pretty_exceptions_show_locals=False)
 log = get_logger(__name__)
 device = get_device()
 
+SIGNAL_BUFFER_SIZE = 2**16
+"""Initial capacity (signals) of the buffers collecting extracted signals."""
+
+SIGNAL_ARRAYS = ("fund_v", "idx_v", "sign_v", "ident_v", "times")
+"""Analysed data arrays stored as <name>.npy in the save path."""
+
+
+def _save_npy(path, arr):
+    """
+    Writes an array to a .npy file atomically: the array is written to a temporary file that then replaces path, so
+    an interrupted save never leaves a truncated file and memory-mapped readers of the old file are not affected.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, np.asarray(arr), allow_pickle=False)
+    os.replace(tmp_path, path)
+
+
+def _grow_buffer(buf, size, n):
+    """
+    Returns a buffer with the first dimension enlarged to size, holding the first n entries of buf.
+    """
+    new_buf = np.empty((size, *buf.shape[1:]), dtype=buf.dtype)
+    new_buf[:n] = buf[:n]
+    return new_buf
+
 
 class AnalysisPipeline:
     """
@@ -54,6 +87,7 @@ class AnalysisPipeline:
         spec,
         logger=None,
         gpu_use=False,
+        loader=None,
     ):
         """
         Constructs all the necessary attributes for the main analysis pipeline of the wavetracker-package to analyse
@@ -84,13 +118,22 @@ class AnalysisPipeline:
                 Logger object used to store analysis feedback (default in None).
             gpu_use : bool, optional
                 If True uses the way faster GPU analysis pipeline (default in False).
+            loader : iterable, optional
+                Yields the data blocks of dataset, e.g. a torch DataLoader reading them ahead in worker processes
+                (default in None, i.e. dataset is iterated directly).
         """
         self.save_path = save_path
+        os.makedirs(self.save_path, exist_ok=True)
+        self._paths = {
+            name: os.path.join(self.save_path, f"{name}.npy")
+            for name in SIGNAL_ARRAYS
+        }
 
         self.data = data
         self.samplerate = samplerate
         self.channels = channels
         self.dataset = dataset
+        self.loader = dataset if loader is None else loader
         self.data_shape = data_shape
         self.cfg = cfg
         self.folder = folder
@@ -114,35 +157,28 @@ class AnalysisPipeline:
         self._get_signals = True
         self.do_tracking = True
 
-        # load
-        if os.path.exists(os.path.join(self.save_path, "fund_v.npy")):
+        # load; the arrays are memory-mapped read-only, pages are read on
+        # demand (the tracking only reads them, results are new arrays)
+        if os.path.exists(self._paths["fund_v"]):
             msg = "Loading pre-analyzed data."
             log.info(msg)
-            self._fund_v = np.load(
-                os.path.join(self.save_path, "fund_v.npy"), allow_pickle=True
-            )
-            self._idx_v = np.load(
-                os.path.join(self.save_path, "idx_v.npy"), allow_pickle=True
-            )
-            self._sign_v = np.load(
-                os.path.join(self.save_path, "sign_v.npy"), allow_pickle=True
-            )
-            self.ident_v = np.load(
-                os.path.join(self.save_path, "ident_v.npy"), allow_pickle=True
-            )
-            self.times = np.load(
-                os.path.join(self.save_path, "times.npy"), allow_pickle=True
-            )
+            loaded = {
+                name: np.load(path, mmap_mode="r", allow_pickle=False)
+                for name, path in self._paths.items()
+            }
+            self._fund_v = loaded["fund_v"]
+            self._idx_v = loaded["idx_v"]
+            self._sign_v = loaded["sign_v"]
+            self.ident_v = loaded["ident_v"]
+            self.times = loaded["times"]
+            self._n = len(self._fund_v)
             self.get_signals = False
             if len(self.ident_v[~np.isnan(self.ident_v)]) > 0:
                 self.do_tracking = False
         else:
             msg = "No pre-analyzed data found."
             log.info(msg)
-            self._fund_v = []
-            self._idx_v = []
-            self._sign_v = []
-            self.ident_v = []
+            self._reset_signals()
             self.times = []
 
         msg = "Analysis pipeline initialized."
@@ -163,33 +199,82 @@ class AnalysisPipeline:
         setting.
         """
         if get_sigs:
-            self._fund_v = []
-            self._idx_v = []
-            self._sign_v = []
-            self.ident_v = []
+            self._reset_signals()
             self.times = []
         self._get_signals = bool(get_sigs)
 
     @property
     def fund_v(self):
         """
-        Assures this vector to be extracted from the class as numpy.array.
+        Filled part of the fundamental frequency buffer (a view, not a copy).
         """
-        return np.array(self._fund_v)
+        return self._fund_v[: self._n]
 
     @property
     def idx_v(self):
         """
-        Assures this vector to be extracted from the class as numpy.array.
+        Filled part of the time index buffer (a view, not a copy).
         """
-        return np.array(self._idx_v)
+        return self._idx_v[: self._n]
 
     @property
     def sign_v(self):
         """
-        Assures this vector to be extracted from the class as numpy.array.
+        Filled part of the signature buffer (a view, not a copy).
+        """
+        return self._sign_v[: self._n]
+
+    @property
+    def ident_v(self):
+        """
+        Filled part of the identity buffer (a view, not a copy). Extracted signals are unassigned (nan) until tracked.
+        """
+        return self._ident_v[: self._n]
+
+    @ident_v.setter
+    def ident_v(self, ident_v):
+        """
+        Sets the identities of all signals, e.g. the tracking result.
         """
-        return np.array(self._sign_v)
+        self._ident_v = np.asarray(ident_v, dtype=np.float64)
+
+    def _reset_signals(self):
+        """
+        Empties the buffers collecting the extracted signals. Capacity is allocated on the first append.
+        """
+        self._n = 0
+        self._fund_v = np.empty(0, dtype=np.float32)
+        self._idx_v = np.empty(0, dtype=np.int32)
+        self._sign_v = np.empty((0, self.Spec.channels), dtype=np.float32)
+        self._ident_v = np.empty(0, dtype=np.float64)
+
+    def _append_signals(self, fund_v, idx_v, sign_v):
+        """
+        Appends extracted signals to the growable buffers "_fund_v", "_idx_v", "_sign_v", and "_ident_v" (as
+        unassigned, i.e. nan). When full, the buffers double in size, so that the total copying work stays linear in
+        the number of signals.
+
+        Parameters
+        ----------
+            fund_v : 1d-array
+                Fundamental frequencies of the new signals.
+            idx_v : 1d-array
+                Time indices of the new signals.
+            sign_v : 2d-array
+                Powers of the new signals on the recording electrodes (signals x channels).
+        """
+        n0, n1 = self._n, self._n + len(fund_v)
+        if n1 > len(self._fund_v):
+            cap = max(2 * len(self._fund_v), n1, SIGNAL_BUFFER_SIZE)
+            self._fund_v = _grow_buffer(self._fund_v, cap, n0)
+            self._idx_v = _grow_buffer(self._idx_v, cap, n0)
+            self._sign_v = _grow_buffer(self._sign_v, cap, n0)
+            self._ident_v = _grow_buffer(self._ident_v, cap, n0)
+        self._fund_v[n0:n1] = fund_v
+        self._idx_v[n0:n1] = idx_v
+        self._sign_v[n0:n1] = sign_v
+        self._ident_v[n0:n1] = np.nan
+        self._n = n1
 
     def run(self):
         """
@@ -228,7 +313,9 @@ class AnalysisPipeline:
             # else:
             #     self.pipeline_CPU()
             self.times = self.Spec.times
-            self.save()
+            # loaded signals are unchanged, only the time axis is new
+            self.save(SIGNAL_ARRAYS if self._get_signals else ("times",))
+            self.Spec.save()
             self.Spec.close()
 
         if self.verbose >= 1:
@@ -247,8 +334,7 @@ class AnalysisPipeline:
                 **self.cfg.harmonic_groups,
                 **self.cfg.tracking,
             )
-            self.save()
-
+            self.save(("ident_v",))
         msg = "Analysis pipeline completed."
         log.info(msg)
 
@@ -259,8 +345,13 @@ class AnalysisPipeline:
         iterations = self.dataset.nblocks
         with get_progress() as pbar:
             desc = "Spectrogram + Harmonic Group"
-            task = pbar.add_task(desc, total=iterations + 1, transient=True)
-            for enu, snippet_data in enumerate(self.dataset):
+            task = pbar.add_task(desc, total=iterations, transient=True)
+            snippets = itertools.islice(self.loader, iterations)
+            if self.loader is not self.dataset:
+                # blocks from loader workers arrive in pinned host memory and
+                # are uploaded on the dataset's stream, one snippet ahead
+                snippets = self.dataset.to_device(snippets)
+            for enu, snippet_data in enumerate(snippets):
                 t0_snip = time.time()
                 snippet_t0 = (
                     self.Spec.itter_count
@@ -270,11 +361,7 @@ class AnalysisPipeline:
 
                 self.logger.debug(f"Snippet {enu} t0: {snippet_t0:.2f}s")
 
-                if (
-                    self.data.shape[0] // self.Spec.snippet_size
-                    == self.Spec.itter_count
-                ):
-                    self.Spec.terminate = True
+                self.Spec.terminate = enu == iterations - 1
 
                 t0_spec = time.time()
                 self.Spec.snippet_spectrogram(
@@ -296,9 +383,6 @@ class AnalysisPipeline:
                         f"--> {t1_snip - t0_snip:.2f}s\n",
                     )
                 pbar.update(task, advance=1)
-
-            # if enu == iterations - 1:
-            #     break
         return
 
     # def pipeline_CPU(self):
@@ -367,65 +451,61 @@ class AnalysisPipeline:
                 self.Spec.spec_freqs,
                 self.cfg,
                 verbose=self.verbose,
+                log_spec=self.Spec.log_scratch[: self.Spec.sum_spec.shape[1]],
             )
-            tmp_fundamentals = get_fundamentals(
+            # all time bins at once; the frequency bins come with them
+            tmp_fund_v, tmp_idx_v, f_idx = get_fundamentals_flat(
                 assigned_hg, self.Spec.spec_freqs
             )
         else:
-            partial_harmonic_groups = partial(
-                harmonic_groups,
+            # all time bins in one compiled call, parallel over time bins
+            spec = np.ascontiguousarray(self.Spec.sum_spec, dtype=np.float32)
+            hg = self.cfg.harmonic_groups
+            if hg["low_threshold"] == 0 or hg["high_threshold"] == 0:
+                std = noise_std(spec)
+                hg["low_threshold"] = std * hg["low_thresh_factor"]
+                hg["high_threshold"] = std * hg["high_thresh_factor"]
+            tmp_fund_v, tmp_idx_v, f_idx = harmonic_groups_batch(
+                spec,
                 self.Spec.spec_freqs,
-                **self.cfg.harmonic_groups,
+                float(hg["low_threshold"]),
+                float(hg["high_threshold"]),
+                float(hg["min_freq"]),
+                float(hg["max_freq"]),
+                float(hg["mains_freq"]),
+                float(hg["mains_freq_tol"]),
+                float(hg["min_good_peak_power"]),
+                int(hg["max_divisor"]),
+                int(hg["min_group_size"]),
+                float(hg["max_freq_tol"]),
             )
 
-            pool = multiprocessing.Pool(self.core_count - 1)
-            a = pool.map(
-                partial_harmonic_groups, self.Spec.sum_spec.transpose()
-            )
-
-            groups_per_time = [a[groups][0] for groups in range(len(a))]
-            tmp_fundamentals = pool.map(fundamental_freqs, groups_per_time)
-            pool.terminate()
-
-        tmp_fund_v = np.hstack(tmp_fundamentals)
-        tmp_idx_v = np.array(
-            np.hstack(
-                [
-                    np.ones(len(f)) * enu
-                    for enu, f in enumerate(tmp_fundamentals)
-                ]
-            ),
-            dtype=int,
-        )
-        f_idx = [
-            np.argmin(np.abs(self.Spec.spec_freqs - f))
-            for i in range(len(tmp_fundamentals))
-            for f in tmp_fundamentals[i]
-        ]
-
-        tmp_sign_v = self.Spec.spec[:, f_idx, tmp_idx_v].transpose()
+        tmp_sign_v = self.Spec.signal_powers(tmp_idx_v, f_idx)
 
         idx_0 = len(self.Spec.times) - len(self.Spec.spec_times)
 
-        self._fund_v.extend(tmp_fund_v)
-        self._idx_v.extend(tmp_idx_v + idx_0)
-        self._sign_v.extend(tmp_sign_v)
-        self.ident_v = np.full(len(self._idx_v), np.nan)
+        self._append_signals(tmp_fund_v, tmp_idx_v + idx_0, tmp_sign_v)
 
-    def save(self):
+    def save(self, names=SIGNAL_ARRAYS):
         """
-        Save analyzed data arrays.
-        """
-        if not os.path.exists(self.save_path):
-            os.makedirs(self.save_path)
-
-        np.save(os.path.join(self.save_path, "fund_v.npy"), self.fund_v)
-        np.save(os.path.join(self.save_path, "ident_v.npy"), self.ident_v)
-        np.save(os.path.join(self.save_path, "idx_v.npy"), self.idx_v)
-        np.save(os.path.join(self.save_path, "times.npy"), self.times)
-        np.save(os.path.join(self.save_path, "sign_v.npy"), self.sign_v)
+        Save analyzed data arrays. The files are independent and written concurrently, every one atomically (see
+        _save_npy).
 
-        self.Spec.save()
+        Parameters
+        ----------
+            names : tuple of str, optional
+                Arrays to save (default all analysed data arrays). Arrays that did not change need not be rewritten.
+        """
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            # list() re-raises errors of the writes
+            list(
+                executor.map(
+                    lambda name: _save_npy(
+                        self._paths[name], getattr(self, name)
+                    ),
+                    names,
+                )
+            )
 
 
 def wavetracker(
@@ -481,12 +561,21 @@ def wavetracker(
 
     # STEP 4: Generate the torch iterator dataset object
     # Just a better way to iterate through the dataset for spectrogram analysis
+    # The loader workers read the snippets into pinned host memory; the
+    # pipeline uploads them on the dataset's CUDA stream, so the upload of
+    # the next snippet is not queued behind the current spectrogram.
     dataset = MultiChannelAudioDataset(
         data_loader=data,
         block_size=better_snippet_size_samples,
         noverlap=snippet_overlap,  # This is NOT the noverlap of the spectrogram!
+        dtype=cfg.spectrogram.get("tensor_dtype", "float32"),
+        stream=torch.cuda.Stream() if device.type == "cuda" else None,
     )
 
+    # Blocks are read ahead in worker processes while the GPU works on the
+    # current snippet
+    loader = make_torch_loader(dataset)
+
     # STEP 5: Generate the Spectrogram object
     spec = Spectrogram(
         samplerate=samplerate,
@@ -516,6 +605,7 @@ def wavetracker(
         logger=log,
         gpu_use=True,
         spec=spec,
+        loader=loader,
     )
 
     if renew: